@@ -0,0 +1,163 @@
+from itertools import product
+from stream import BaseStream, FrameLog
+import multiprocessing as mp
+import numpy as np
+import subprocess
+import argparse
+import resource
+import json
+import glob
+import time
+import cv2
+import os
+
+import main as turret
+
+
+def load_frames(path, limit=None):
+    if FrameLog.exists(path):
+        frames, _ = FrameLog(path).read()
+        frames = list(frames[:limit])
+    elif os.path.isdir(path):
+        names = sorted(glob.glob(os.path.join(path, '*.jpg')) + glob.glob(os.path.join(path, '*.png')))
+        frames = [cv2.imread(i) for i in names[:limit]]
+    else:
+        capture = cv2.VideoCapture(path)
+        frames = []
+        while limit is None or len(frames) < limit:
+            ok, frame = capture.read()
+            if not ok: break
+            frames.append(frame)
+        capture.release()
+    return [i for i in frames if i is not None]
+
+
+def parse_value(value):
+    try: return json.loads(value)
+    except ValueError: return getattr(cv2, value, value)
+
+
+def parse_params(items):
+    # ['FACE_SCALE_FACTOR=1.1,1.3', ...] -> [{'FACE_SCALE_FACTOR': 1.1}, {'FACE_SCALE_FACTOR': 1.3}]
+    grid = []
+    for item in items:
+        name, values = item.split('=', 1)
+        grid.append([(name, parse_value(i)) for i in values.split(';' if ';' in values else ',')])
+    return [dict(i) for i in product(*grid)]
+
+
+def percentiles(samples):
+    if not samples: return {}
+    samples = np.array(samples) * 1000
+    return {
+        'p50': round(float(np.percentile(samples, 50)), 3),
+        'p99': round(float(np.percentile(samples, 99)), 3),
+        'mean': round(float(np.mean(samples)), 3),
+    }
+
+
+def run(frames, size, params, handler, loops, motion=False):
+    turret.WIDTH, turret.HEIGHT = size
+    # The change gate opens on turret idle time and FACE_CHECK_INTERVAL (wall clock), so it is off
+    # unless asked for (--param GATE_SCALE=0.125)
+    turret.GATE_SCALE = None
+    for name, value in params.items(): setattr(turret, name, value)
+    if motion: turret.MOTION = turret.SimMotion  # Steps in the background, their timing is measured
+    # Every stage runs on every frame and is waited for, so results don't depend on the wall clock
+    turret.STAGES = {name: {'fps': None, 'timeout': 0} for name in turret.STAGES}
+
+    core = turret.Core(stream=BaseStream())
+    frames = [cv2.resize(i, size) for i in frames]
+    logic = core.handlers[handler](core) if handler else None
+    core.set_detectors(logic.detectors if logic else core.detectors)  # Everything without a handler
+    samples = {}
+
+    def record(name, value): samples.setdefault(name, []).append(value)
+
+    if motion: core.motion.start()
+    start = time.perf_counter()
+    for _ in range(loops):
+        for frame in frames:
+            # Sweep back and forth over the rotation range, the turret never rests
+            if motion and not core.motion.sleep.is_set(): core.motion.move_to(-0.25 if core.motion.abs_rotation > 0 else 0.25)
+            begin = time.perf_counter()
+            core.process(frame)
+            record('core', time.perf_counter() - begin)
+            for name, value in core.timings.items(): record(name, value)
+
+            begin = time.perf_counter()
+            cv2.imencode('.jpg', core.snapshot.overlay.apply(core.snapshot.gray))
+            record('encode', time.perf_counter() - begin)
+            begin = time.perf_counter()
+            cv2.imencode('.jpg', core.snapshot.gray)
+            record('encode_raw', time.perf_counter() - begin)
+
+            if logic is None: continue
+            logic.snapshot = core.snapshot
+            logic.timestamp = time.time()
+            begin = time.perf_counter()
+            logic.handle()
+            record('handler', time.perf_counter() - begin)
+    elapsed = time.perf_counter() - start
+    core.executor.shutdown()
+    if motion:
+        core.motion.stop()
+        samples['step_interval'] = core.motion.intervals()
+
+    count = len(frames) * loops
+    return {
+        'width': size[0],
+        'height': size[1],
+        'params': {k: v if isinstance(v, (int, float, str, list)) else str(v) for k, v in params.items()},
+        'handler': handler,
+        'frames': count,
+        'fps': round(count / elapsed, 2),
+        'stages': {name: percentiles(values) for name, values in samples.items()},
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'step_jitter': core.motion.timer.status() if motion else None,
+    }
+
+
+def measure(path, limit, size, params, handler, loops, motion):
+    # One combination in a fresh process: ru_maxrss is a lifetime peak, it would carry over between runs
+    with mp.get_context('spawn').Pool(1) as pool:
+        return pool.apply(run_file, (path, limit, size, params, handler, loops, motion))
+
+
+def run_file(path, limit, size, params, handler, loops, motion):
+    return run(load_frames(path, limit), size, params, handler, loops, motion)
+
+
+def revision():
+    try: return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError): return None
+
+
+def main(args):
+    if not load_frames(args.input, 1): print('No frames found in', args.input); return
+    sizes = [tuple(int(i) for i in size.split('x')) for size in args.size]
+    results = []
+
+    for size, params in product(sizes, parse_params(args.param) or [{}]):
+        result = measure(args.input, args.limit, size, params, args.handler, args.loops, args.motion)
+        results.append(result)
+        stages = ' '.join('%s=%.1f/%.1fms' % (k, v['p50'], v['p99']) for k, v in result['stages'].items())
+        print('%dx%d %s: %.1f FPS | %s | RSS %d KB' % (size + (params, result['fps'], stages, result['max_rss_kb'])))
+
+    report = {'revision': revision(), 'input': args.input, 'time': time.time(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as file: json.dump(report, file, indent=2)
+        print('Saved results to', args.output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay recorded frames through the detection pipeline')
+    parser.add_argument('input', help='Path to a frame log (RecordStream), frames folder (*.jpg, *.png) or video file')
+    parser.add_argument('--size', nargs='+', default=['%sx%s' % (turret.WIDTH, turret.HEIGHT)], help='Frame sizes, e.g. 320x240 640x480')
+    parser.add_argument('--param', nargs='*', default=[], help='main.py constants grid, e.g. FACE_SCALE_FACTOR=1.1,1.3')
+    parser.add_argument('--handler', default=None, help='Logic handler name to run on every frame (e.g. "Marker Tracker")')
+    parser.add_argument('--loops', default=1, type=int, help='Replay the frames this many times')
+    parser.add_argument('--motion', action='store_true', help='Step a simulated turret meanwhile and report step timing')
+    parser.add_argument('--limit', default=None, type=int, help='Max frames to load')
+    parser.add_argument('--output', default=None, help='Save machine-readable results (JSON) to this file')
+    main(parser.parse_args())
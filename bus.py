@@ -0,0 +1,69 @@
+from threading import Condition
+from weakref import WeakSet
+import time
+
+__all__ = [
+    'FrameBus',
+    'Subscription',
+]
+
+
+class FrameBus:
+    def __init__(self):
+        self.condition = Condition()
+        self.seq = 0        # Last published frame number (0 = nothing yet)
+        self.timestamp = 0  # Last published frame timestamp
+        self.frame = None
+        self.subscriptions = WeakSet()
+
+    def publish(self, frame, timestamp=None):
+        with self.condition:
+            self.seq += 1
+            self.timestamp = timestamp or time.time()
+            self.frame = frame
+            self.condition.notify_all()
+            return self.seq
+
+    def subscribe(self):
+        subscription = Subscription(self)
+        with self.condition: self.subscriptions.add(subscription)
+        return subscription
+
+    def wait_consumed(self, seq=None, timeout=None):
+        # Waits until every open subscription has received frame seq (default: the last published one),
+        # returns False on timeout. Lets a producer go in lockstep with its consumers instead of dropping frames
+        with self.condition:
+            seq = self.seq if seq is None else seq
+            return self.condition.wait_for(
+                lambda: all(i.closed or i.seq >= seq for i in self.subscriptions), timeout
+            )
+
+
+class Subscription:
+    def __init__(self, bus):
+        self.bus = bus
+        self.seq = bus.seq  # Last received frame number
+        self.received = 0
+        self.dropped = 0    # Frames published but never received
+        self.closed = False
+
+    def close(self):
+        # Wakes up the waiting consumer, next() returns None from now on
+        with self.bus.condition:
+            self.closed = True
+            self.bus.condition.notify_all()
+
+    def next(self, timeout=None):
+        # Waits for a frame newer than the last received one, returns (seq, timestamp, frame)
+        with self.bus.condition:
+            ready = self.bus.condition.wait_for(lambda: self.closed or self.bus.seq > self.seq, timeout)
+            if self.closed or not ready: return None
+            seq, timestamp, frame = self.bus.seq, self.bus.timestamp, self.bus.frame
+            if self.received: self.dropped += seq - self.seq - 1
+            self.received += 1
+            self.seq = seq
+            self.bus.condition.notify_all()  # Producers waiting in wait_consumed
+        return seq, timestamp, frame
+
+    def status(self):
+        return {'seq': self.seq, 'received': self.received, 'dropped': self.dropped}
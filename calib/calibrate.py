@@ -1,48 +1,113 @@
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
 import numpy as np
 import argparse
+import hashlib
+import json
 import cv2
+import os
+
+PATTERN_SIZE = (9, 6)
+OUTPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'calibration.json')
+
+
+def file_hash(filename):
+    with open(filename, 'rb') as file: return hashlib.sha1(file.read()).hexdigest()
+
+
+def find_corners(filename):
+    # Runs in a worker process, returns a JSON friendly cache entry
+    image = cv2.imread(filename, cv2.IMREAD_GRAYSCALE)
+    if image is None: return {'error': 'Read error'}
+    entry = {'size': [image.shape[1], image.shape[0]]}
+    ok, corners = cv2.findChessboardCorners(image, PATTERN_SIZE)
+    if not ok: return dict(entry, error='Chessboard not found')
+    term = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+    cv2.cornerSubPix(image, corners, (5, 5), (-1, -1), term)
+    return dict(entry, corners=corners.reshape(-1, 2).tolist())
+
+
+def load_cache(path):
+    if not os.path.isfile(path): return {}
+    with open(path) as file: return json.load(file)
+
+
+def save_cache(path, cache):
+    with open(path, 'w') as file: json.dump(cache, file)
 
 
 def main(args):
-    img_names = glob(args.folder + '/' + '*.jpg')
+    img_names = sorted(glob(args.folder + '/' + '*.jpg'))
+    cache_path = args.cache or os.path.join(args.folder, 'corners.json')
+    cache = load_cache(cache_path)  # File hash -> corners (or error)
+
+    # Only new (or changed) snapshots are processed, in parallel
+    hashes = [file_hash(i) for i in img_names]
+    todo = [(name, key) for name, key in zip(img_names, hashes) if key not in cache]
+    if todo:
+        print('Processing %d new snapshot(s)...' % len(todo))
+        with ProcessPoolExecutor(args.jobs) as executor:
+            for (name, key), entry in zip(todo, executor.map(find_corners, [name for name, _ in todo])):
+                cache[key] = entry
+        save_cache(cache_path, cache)
 
-    pattern_size = (9, 6)
-    pattern_points = np.zeros((np.prod(pattern_size), 3), np.float32)
-    pattern_points[:, :2] = np.indices(pattern_size).T.reshape(-1, 2)
+    pattern_points = np.zeros((np.prod(PATTERN_SIZE), 3), np.float32)
+    pattern_points[:, :2] = np.indices(PATTERN_SIZE).T.reshape(-1, 2)
     pattern_points *= args.dimension
 
+    names = []
     obj_points = []
     img_points = []
-    height, width = cv2.imread(img_names[0], cv2.IMREAD_GRAYSCALE).shape[:2]
-
-    for filename in img_names:
-        print('Processing %s... ' % filename, end='')
-        image = cv2.imread(filename, 0)
-        if image is None: print('FAIL: Read error'); continue
-        if (height, width) != image.shape: print('FAIL: Size mismatch'); continue
-        ok, corners = cv2.findChessboardCorners(image, pattern_size)
-        if not ok: print('FAIL: Chessboard not found'); continue
-
-        if ok:
-            print('OK!')
-            term = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, args.dimension, 0.001)
-            cv2.cornerSubPix(image, corners, (5, 5), (-1, -1), term)
-
-        img_points.append(corners.reshape(-1, 2))
+    size = None
+
+    for filename, key in zip(img_names, hashes):
+        entry = cache[key]
+        if 'error' in entry: print('%s: FAIL: %s' % (filename, entry['error'])); continue
+        if os.path.basename(filename) in args.exclude: print('%s: Excluded' % filename); continue
+        size = size or entry['size']
+        if entry['size'] != size: print('%s: FAIL: Size mismatch' % filename); continue
+        names.append(filename)
+        img_points.append(np.array(entry['corners'], np.float32))
         obj_points.append(pattern_points)
 
-    rms, matrix, dist_coefs, rvecs, tvecs = cv2.calibrateCamera(obj_points, img_points, (width, height), None, None)
-    
+    if not names: print('\nNo usable snapshots'); return
+
+    rms, matrix, dist_coefs, rvecs, tvecs = cv2.calibrateCamera(obj_points, img_points, tuple(size), None, None)
+
+    # Per snapshot reprojection error (px), the worst ones are candidates for --exclude
+    errors = {}
+    for name, obj, img, rvec, tvec in zip(names, obj_points, img_points, rvecs, tvecs):
+        projected = cv2.projectPoints(obj, rvec, tvec, matrix, dist_coefs)[0].reshape(-1, 2)
+        errors[os.path.basename(name)] = float(np.sqrt(np.mean(np.sum((projected - img) ** 2, axis=1))))
+
+    print('\nREPROJECTION ERRORS:\n')
+    for name, error in sorted(errors.items(), key=lambda x: -x[1]):
+        print('%8.3f  %s' % (error, name))
+
     print('\nCALIBRATION RESULTS:\n')
     print('RMS:', rms)
     print('Camera matrix:\n', matrix)
     print('Distortion coefficients:', dist_coefs.ravel())
 
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as file:
+        json.dump({
+            'size': size,
+            'matrix': matrix.tolist(),
+            'distortion': dist_coefs.ravel().tolist(),
+            'rms': rms,
+            'errors': errors,
+        }, file, indent=2)
+    print('\nSaved to', os.path.normpath(args.output))
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Get camera calibration coefficients')
     parser.add_argument('--folder', default='snapshots', help='Path to snapshots folder (default: snapshots)')
     parser.add_argument('--dimension', default=25.0, type=float, help='Cell side length (mm)')
+    parser.add_argument('--output', default=OUTPUT, help='Calibration file loaded by the turret (default: data/calibration.json)')
+    parser.add_argument('--cache', help='Corners cache file (default: <folder>/corners.json)')
+    parser.add_argument('--jobs', type=int, help='Worker processes (default: CPU count)')
+    parser.add_argument('--exclude', nargs='*', default=[], help='Snapshot file names to leave out')
     args = parser.parse_args()
     main(args)
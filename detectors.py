@@ -0,0 +1,117 @@
+from tracking import FaceTracker
+from pyramid import *
+import numpy as np
+import time
+import cv2
+
+__all__ = [
+    'Downscaler',
+    'ChangeGate',
+    'DetectorRegistry',
+    'marker_parameters',
+    'marker_detector',
+    'face_detector',
+    'synthetic_frame',
+]
+
+
+class Downscaler:
+    # Detection image in a buffer of its own, the image never leaves the detector
+    # and a detector never runs in two threads at once, so one buffer is enough
+    def __init__(self, scale):
+        self.scale = scale
+        self.buffer = None
+
+    def __call__(self, gray):
+        if self.scale == 1: return gray
+        shape = (round(gray.shape[0] * self.scale), round(gray.shape[1] * self.scale))
+        if self.buffer is None or self.buffer.shape != shape: self.buffer = np.empty(shape, gray.dtype)
+        return downscale(gray, self.scale, dst=self.buffer)
+
+
+class ChangeGate:
+    # Frame differencing on a tiny frame against the last frame the detectors ran on,
+    # so slow changes add up instead of slipping through frame by frame
+    def __init__(self, scale=0.125, threshold=12, pixels=2):
+        self.downscaler = Downscaler(scale)
+        self.threshold = threshold  # Gray level difference of a changed pixel
+        self.pixels = pixels        # Changed pixels needed to open the gate
+        self.reference = None
+        self.position = None        # Turret position the reference was taken at
+
+    def __call__(self, gray, position=None, force=False):
+        # True if the detectors have to run. The turret moving (position = None) or having moved since
+        # the reference shifts the whole view, old detections are in wrong coordinates then
+        small = self.downscaler(gray)
+        changed = (
+            force or position is None or position != self.position or self.reference is None or
+            self.reference.shape != small.shape or
+            np.count_nonzero(cv2.absdiff(small, self.reference) > self.threshold) >= self.pixels
+        )
+        if changed:
+            self.reference = small.copy()
+            self.position = position
+        return changed
+
+
+class DetectorRegistry:
+    # Detectors are built (and warmed up) once, the same specs are used to build them in worker processes
+    def __init__(self):
+        self.specs = {}      # Name -> (factory, params)
+        self.detectors = {}  # Name -> detect(gray) (thread mode only)
+        self.warmup = {}     # Name -> first (cold) run time (seconds)
+
+    def add(self, name, factory, **params):
+        self.specs[name] = (factory, params)
+
+    def build(self, shape):
+        frame = synthetic_frame(shape)
+        for name, (factory, params) in self.specs.items():
+            detector = factory(**params)
+            start = time.time()
+            detector(frame)
+            self.warmup[name] = time.time() - start
+            self.detectors[name] = detector
+
+    def __getitem__(self, name):
+        return self.detectors[name]
+
+    def __contains__(self, name):
+        return name in self.specs
+
+    def __iter__(self):
+        return iter(self.specs)
+
+
+def marker_parameters(**params):
+    parameters = cv2.aruco.DetectorParameters_create()
+    for name, value in params.items(): setattr(parameters, name, value)
+    return parameters
+
+
+def marker_detector(dictionary, scale=1, refine=False, params=None):
+    aruco_dict = cv2.aruco.Dictionary_get(dictionary)
+    parameters = marker_parameters(**(params or {}))
+    detection = Downscaler(scale)
+
+    def detect(gray):
+        corners, ids, _ = cv2.aruco.detectMarkers(detection(gray), aruco_dict, parameters=parameters)
+        corners = upscale_corners(corners, scale)
+        if refine: corners = refine_corners(gray, corners, scale)
+        return corners, ids
+
+    return detect
+
+
+def face_detector(path, interval=1, margin=0.5, scale=1, **params):
+    tracker = FaceTracker(cv2.CascadeClassifier(path), interval, margin, **params)
+    detection = Downscaler(scale)
+    return lambda gray: upscale_rects(tracker(detection(gray)), scale)
+
+
+def synthetic_frame(shape):
+    # Noise with a dark square: goes through thresholding, contour search and cascade scans like a real frame
+    frame = np.random.RandomState(0).randint(64, 192, shape, np.uint8)
+    h, w = shape[:2]
+    frame[h // 4:h * 3 // 4, w // 3:w * 2 // 3] = 0
+    return frame
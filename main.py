@@ -1,4 +1,14 @@
+from concurrent.futures import ThreadPoolExecutor
 from server import Server
+from scheduler import Scheduler
+from metrics import metrics
+from pipeline import *
+from tracking import *
+from markers import Markers
+from undistort import *
+from detectors import *
+from overlay import Overlay
+from snapshot import Snapshot
 from stream import *
 from motion import *
 import numpy as np
@@ -7,12 +17,21 @@ import cv2
 
 
 STREAM = CVStream            # Stream handler
-WIDTH = 320                  # Frame width (None = max)
-HEIGHT = 240                 # Frame height (None = max)
+STREAM_PARAMS = {}           # Extra stream params (e.g. {'path': 'recording', 'speed': 0} for ReplayStream,
+                             # {'format': 'yuv', 'mjpeg': True, 'flip': FLIP} for RPiStream, add 'backend': 'sim' to test off-device)
+RECORD_PATH = None           # Record camera frames to this folder (None = don't record)
+WIDTH = 640                  # Frame width (None = max)
+HEIGHT = 480                 # Frame height (None = max)
 FPS = None                   # Stream FPS (None = max)
 FLIP = None                  # Frame flip mode (0 = H | 1 = V | -1 = both | None = no flip)
+BUFFERS = 4                  # Preallocated frame buffers per stage (0 = allocate every frame)
+DETECTION_SCALE = 0.5        # Detectors work on the frame downscaled by this factor (1 = full resolution)
 
-MOTION = FakeMotion          # Motion handler
+PIPELINE = 'thread'          # Vision pipeline mode ('thread' = single thread | 'process' = worker processes)
+PIPELINE_SLOTS = 4           # Shared memory frame slots per ring (process mode only)
+PIPELINE_MAX_AGE = 2         # Worker results older than this are dropped (seconds, keep below ARMING_TIMEOUT)
+
+MOTION = FakeMotion          # Motion handler (SimMotion = records step pulses, used by bench.py --motion)
 MOTION_PINS = {
     'ENABLE': 3,             # A4988 enable pin
     'STEP': 5,               # A4988 step pin
@@ -21,8 +40,9 @@ MOTION_PINS = {
     'FIRE': 24,              # Fire pin
 }
 MOTION_PARAMS = {
-    'SPEED': 30,             # Normal speed (steps per second)
-    'SLOWSPEED': 5,          # Slow speed (steps per second)
+    'SPEED': 100,            # Normal (top) speed (steps per second)
+    'SLOWSPEED': 5,          # Slow (top) speed (steps per second)
+    'ACCELERATION': 300,     # Acceleration / deceleration (steps per second^2)
     'REVERSE': False,        # Reverse direction
     'REVOLUTION': 320,       # Steps per full revolution
     'ROTATION_RANGE': 0.5,   # Rotation range limit (0 = no limits)
@@ -31,6 +51,8 @@ MOTION_PARAMS = {
     'RECHARGE_TIME': 5,      # Aka minimal time between shots
     'MIN_PWM': 0,            # Min servo PWM
     'MAX_PWM': 50,           # Max servo PWM
+    'SPIN_TIME': 0.002,      # Spin before every step for precise timing (seconds, 0 = sleep only)
+    'REALTIME': False,       # Run motion thread with realtime priority (Linux, needs root)
 }
 
 ARMING_TIMEOUT = 5                         # Time to wait before arming
@@ -41,9 +63,13 @@ ARMING_TEXT_POS = (5, 20)                  # Arming status text param: position
 FACE_HAAR_PATH = 'data/face_default.xml'   # Path to haar cascade file (for face detection)
 FACE_SCALE_FACTOR = 1.1                    # Face detection param: scaleFactor
 FACE_MIN_NEIGHBOURS = 5                    # Face detection param: minNeighbours
-FACE_MIN_SIZE = (50, 50)                 # Face detection param: minSize
+FACE_MIN_SIZE = (50, 50)                 # Face detection param: minSize (detection image px)
 FACE_FLAGS = cv2.CASCADE_SCALE_IMAGE       # Face detection param: flags
+FACE_SCAN_INTERVAL = 10                    # Full frame face scan interval while tracking (frames, 1 = always)
+FACE_ROI_MARGIN = 0.5                      # Face search area expansion while tracking (fraction of face size)
 
+CALIBRATION_PATH = 'data/calibration.json'  # Written by calib/calibrate.py, overrides the values below if present
+CALIBRATION_SIZE = (320, 240)              # Frame size the camera was calibrated at
 CAMERA_MATRIX = np.array([                 # Camera matrix coefficients (calibration result)
     [544.70473098, 0.0, 177.46434358],
     [0.0, 547.27945612, 146.11552008],
@@ -57,8 +83,33 @@ CAMERA_DISTORTION = np.array([             # Camera distortion coefficients (cal
     -1.22638201e+02,
 ])
 
+STAGES = {                                 # Processing stages rates
+    'markers': {'fps': None, 'timeout': 0},   # Marker detection: every frame (fps = None), always waited for
+    'faces': {'fps': 5, 'timeout': 0.5},      # Face detection: target rate, result is never older than timeout
+    'overlay': {'fps': None},                 # Overlay layer update (drawn at encode time, annotated streams only)
+    'encode': {'fps': 15},                    # Stream encoding
+}
+
+UNDISTORT = 'points'                       # Lens distortion correction (None | 'points' = detections only | 'frame' = full frame)
+UNDISTORT_CACHE = 'data/cache'             # Folder for precomputed undistortion tables (None = don't cache)
+
+TRACKING_LEAD = 0.1                        # Target position prediction ahead of now (seconds)
+
 MARKERS_DICT = cv2.aruco.DICT_6X6_50       # Aruco markers dict
 MARKER_LENGTH = 33                         # Marker side length (mm)
+MARKER_POSE = True                         # Estimate marker poses (distance is used to prioritize targets)
+MARKER_REFINE = True                       # Refine marker corners to sub-pixel accuracy in the full resolution frame
+MARKER_PARAMS = {                          # Aruco DetectorParameters overrides
+    'minMarkerPerimeterRate': 0.1,            # Smaller markers can't be decoded at the detection scale anyway
+    'adaptiveThreshWinSizeStep': 20,          # 2 threshold passes (3 and 23 px windows) instead of 3
+    'cornerRefinementMethod': cv2.aruco.CORNER_REFINE_NONE,  # Done by MARKER_REFINE at full resolution
+}
+IDLE_DETECTORS = ('markers', 'faces')      # Detectors to run while no handler is active (manual mode: faces arm the turret)
+
+GATE_SCALE = 0.125                         # Frame differencing scale, detectors only run if the view changed (None = always run)
+GATE_THRESHOLD = 12                        # Gray level difference that counts as a changed pixel
+GATE_PIXELS = 2                            # Changed pixels (at GATE_SCALE) needed to run the detectors
+FACE_CHECK_INTERVAL = 1                    # Detectors run at least this often anyway (seconds, keep below ARMING_TIMEOUT)
 
 LOGIC_HANDLERS = [
     'MarkerTrackingHandler',
@@ -68,57 +119,125 @@ LOGIC_HANDLERS = [
 
 
 class Core(BaseStream):
-    def __init__(self):
+    def __init__(self, stream=None):
         super().__init__()
-        self.stream = STREAM(width=WIDTH, height=HEIGHT, fps=FPS)
+        self.stream = stream or STREAM(width=WIDTH, height=HEIGHT, fps=FPS, buffers=BUFFERS, **STREAM_PARAMS)
+        self.camera_flip = getattr(self.stream, 'flip', None)  # Flip the camera already applies (RPiStream)
+        # Camera encoded MJPEG (/stream?overlay=camera) only if it shows the same view as the other streams
+        self.camera = self.stream if (
+            getattr(self.stream, 'mjpeg', False) and self.stream.quality == Server.CAMERA_FEED[1] and
+            self.camera_flip == FLIP and UNDISTORT != 'frame'
+        ) else None
+        if RECORD_PATH: self.stream = RecordStream(self.stream, RECORD_PATH)
         self.motion = MOTION(MOTION_PINS, MOTION_PARAMS)
         self.server = Server(self)
-        self.event = self.stream.subscribe()
+        self.subscription = self.stream.subscribe()
 
         self.handlers = {globals()[i].name: globals()[i] for i in LOGIC_HANDLERS}
-        self.aruco_dict = cv2.aruco.Dictionary_get(MARKERS_DICT)
-        self.face_cascade = cv2.CascadeClassifier(FACE_HAAR_PATH)
-        self.draw_arming_text = lambda img, text, color: cv2.putText(
-            img, text, ARMING_TEXT_POS, ARMING_TEXT_FONT, ARMING_TEXT_FONT_SCALE, color, 1
+        self.detectors = DetectorRegistry()
+        self.detectors.add(
+            'markers', marker_detector,
+            dictionary=MARKERS_DICT,
+            scale=DETECTION_SCALE,
+            refine=MARKER_REFINE,
+            params=MARKER_PARAMS
         )
+        self.detectors.add(
+            'faces', face_detector,
+            path=FACE_HAAR_PATH,
+            interval=FACE_SCAN_INTERVAL,
+            margin=FACE_ROI_MARGIN,
+            scale=DETECTION_SCALE,
+            scaleFactor=FACE_SCALE_FACTOR,
+            minNeighbors=FACE_MIN_NEIGHBOURS,
+            minSize=FACE_MIN_SIZE,
+            flags=FACE_FLAGS
+        )
+        if PIPELINE != 'process': self.detectors.build((HEIGHT or 480, WIDTH or 640))  # Workers build their own
+        self.text_style = {'org': ARMING_TEXT_POS, 'fontFace': ARMING_TEXT_FONT, 'fontScale': ARMING_TEXT_FONT_SCALE}
         self.last_face_time = time.time()
+        self.executor = ThreadPoolExecutor(2)  # OpenCV releases the GIL, so detectors run in parallel
+        self.scheduler = Scheduler(self.executor)
+        for name, params in STAGES.items(): self.scheduler.add(name, **params)
+        self.timings = self.scheduler.timings  # Stage name -> last run time (seconds)
+
+        self.flip_pool = BufferPool(BUFFERS)
+        self.gray_pool = BufferPool(BUFFERS)
+        self.stage_pools = {}  # Stage name -> BufferPool (async stage frame copies)
 
         self.handler = None
-        self.frame = None
+        self.pipeline = None
+        self.overlay = Overlay()
+        self.snapshot = Snapshot.empty()  # Latest published frame results (the only state other threads read)
         self.gray = None
-        self.markers = []
-        self.faces = []
+        self.jpeg = None  # (seq, bytes) from the encoder process (process mode only)
+        self.markers = Markers()
+        self.faces = []       # Face rects for aiming (undistorted with UNDISTORT = 'points')
+        self.face_rects = []  # Face rects as detected, drawn onto the frame
+        matrix, distortion, size = load_calibration(CALIBRATION_PATH, CAMERA_MATRIX, CAMERA_DISTORTION, CALIBRATION_SIZE)
+        self.undistorter = Undistorter(matrix, distortion, size, UNDISTORT_CACHE)
+        self.camera_matrix = self.undistorter.scaled((WIDTH or size[0], HEIGHT or size[1]))  # Working resolution
+        self.camera_distortion = self.undistorter.distortion if UNDISTORT != 'frame' else None  # Frames are already fixed
+        self.undistort_pool = BufferPool(BUFFERS)
+        self.active = set()  # Names of the detectors being run
+        self.gate = GATE_SCALE and ChangeGate(GATE_SCALE, GATE_THRESHOLD, GATE_PIXELS)
+        self.last_detection = 0  # Last time the gate let a frame through to the detectors
+        self.pending = set()     # Detectors that haven't run since the gate last opened
+        self.versions = {}       # Detector name -> version of the result processed last (stage runs / result seq)
+        self.set_detectors(IDLE_DETECTORS)
 
     def set_handler(self, name):
         print('SWITCHING HANDLER TO:', name)
         if self.handler is not None: self.handler.stop()
-        if name is None: self.handler = None; return
+        if name is None:
+            self.handler = None
+            self.set_detectors(IDLE_DETECTORS)
+            return
         self.handler = self.handlers[name](self)
+        self.set_detectors(self.handler.detectors)
         self.handler.start()
 
-    def process_markers(self):
-        corners, ids, _ = cv2.aruco.detectMarkers(self.gray, self.aruco_dict)
-        self.markers = []
-        if ids is None: return
-        centers = [np.mean(c[0], axis=0).astype(int).tolist() for c in corners]
-        self.markers = [{
-            'id': int(id[0]),
-            'corners': co.astype(int).tolist(),
-            'center': ce
-        } for co, id, ce in zip(corners, ids, centers)]
-        # rvec, tvec, _ = cv2.aruco.estimatePoseSingleMarkers(corners, MARKER_LENGTH, CAMERA_MATRIX, CAMERA_DISTORTION)
-        # for i in self.markers: i.update(rvec=rvec.tolist(), tvec=tvec.tolist())
-        cv2.aruco.drawDetectedMarkers(self.frame, corners, borderColor=(0, 0, 255))
-
-    def process_faces(self):
-        faces = self.face_cascade.detectMultiScale(
-            self.gray,
-            scaleFactor=FACE_SCALE_FACTOR,
-            minNeighbors=FACE_MIN_NEIGHBOURS,
-            minSize=FACE_MIN_SIZE,
-            flags=FACE_FLAGS
-        )
-        self.faces = [] if not len(faces) else faces.tolist()
+    def set_detectors(self, names):
+        # Detectors nobody needs don't run, their results are cleared
+        active = set(names)
+        for name in self.detectors:
+            if name in active or name not in self.active: continue
+            self.scheduler.reset(name)
+            if self.pipeline: self.pipeline.enable(name, False)
+        for name in active - self.active:
+            if self.pipeline: self.pipeline.enable(name)
+        self.pending |= active - self.active  # Newly needed detectors run on the next frame, gate or not
+        self.active = active
+        if 'markers' not in active: self.clear_markers()
+        if 'faces' not in active: self.process_faces(None)
+
+    def clear_markers(self):
+        self.markers = Markers()
+        self.versions.pop('markers', None)
+
+    def process_markers(self, detection, version):
+        # Pose and undistortion only for a new result (version = stage runs / result seq),
+        # a cached one (closed gate, rate limit) was processed already
+        if self.versions.get('markers') == version: return
+        self.versions['markers'] = version
+        markers = Markers.from_detection(*detection)
+        if MARKER_POSE: markers.estimate_pose(MARKER_LENGTH, self.camera_matrix, self.camera_distortion)
+        if UNDISTORT == 'points': markers.undistort(self.camera_matrix, self.undistorter.distortion)
+        self.markers = markers
+
+    def process_faces(self, faces, version=None):
+        # No face check has finished yet (or faces aren't detected at all), stay disarmed
+        if faces is None:
+            self.faces = self.face_rects = []
+            self.versions.pop('faces', None)
+            self.motion.armed = False
+            self.last_face_time = time.time()
+            return
+        if self.versions.get('faces') != version:  # Same as process_markers, the arming countdown goes on anyway
+            self.versions['faces'] = version
+            self.face_rects = [] if not len(faces) else np.asarray(faces).tolist()
+            if UNDISTORT == 'points': faces = self.undistorter.rects(faces, self.gray.shape[1::-1])
+            self.faces = [] if not len(faces) else np.asarray(faces).tolist()
 
         if self.faces:
             self.motion.armed = False
@@ -126,14 +245,105 @@ class Core(BaseStream):
         elif time.time() - self.last_face_time >= ARMING_TIMEOUT:
             self.motion.armed = True
 
-        for (x, y, w, h) in self.faces: cv2.rectangle(self.frame, (x, y), (x + w, y + h), (0, 255, 0), 1)
-        if self.motion.armed: self.draw_arming_text(self.frame, 'ARMED', (0, 0, 255))
-        elif self.faces: self.draw_arming_text(self.frame, 'DISARMED', (0, 255, 0))
-        else: self.draw_arming_text(self.frame, 'ARMING', (0, 200, 255))
+    def draw(self):
+        # Only shapes are collected here, pixels are touched by the encoder and only for annotated streams
+        if self.motion.armed: text, color = 'ARMED', (0, 0, 255)
+        elif self.faces: text, color = 'DISARMED', (0, 255, 0)
+        else: text, color = 'ARMING', (0, 200, 255)
+        self.overlay = Overlay(self.markers.corners, self.face_rects, text, color, self.text_style)
+
+    def start_pipeline(self, shape):
+        self.pipeline = Pipeline(shape, PIPELINE_SLOTS, PIPELINE_MAX_AGE)
+        for name, (factory, params) in self.detectors.specs.items():
+            self.pipeline.add(name, self.pipeline.gray, factory, **params)
+            self.pipeline.enable(name, name in self.active)
+        self.pipeline.add('encoder', self.pipeline.frames, jpeg_encoder, quality=Server.PIPELINE_FEED[1])
+        self.pipeline.start()
+
+    def flip(self, frame):
+        if FLIP is None or FLIP == self.camera_flip: return frame
+        return cv2.flip(frame, FLIP, dst=self.flip_pool.next(frame.shape))
+
+    def to_gray(self, frame):
+        if frame.ndim == 2: gray = frame  # Already gray (e.g. Y plane of a YUV capture)
+        else: gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.gray_pool.next(frame.shape[:2]))
+        if UNDISTORT != 'frame': return gray
+        return self.undistorter.frame(gray, dst=self.undistort_pool.next(gray.shape))
+
+    def detection_due(self):
+        # Static view and idle turret: the previous results still hold, except that faces are checked regularly
+        # so the arming countdown never runs on stale results alone
+        if not self.gate: return True
+        now = time.time()
+        moving = self.motion.sleep.is_set() or self.motion.velocity
+        with metrics.timer('stage_seconds', stage='gate'):
+            due = self.gate(self.gray, None if moving else self.motion.abs_rotation, now - self.last_detection >= FACE_CHECK_INTERVAL)
+        if due: self.last_detection = now
+        else: metrics.count('gated_frames_total')
+        return due
+
+    def publish(self, image, timestamp=None):
+        # Working state (gray, markers, ...) is only touched by this thread, everybody else gets
+        # a snapshot of it: consistent results of one frame, swapped in with a single assignment
+        self.snapshot = Snapshot.create(
+            self.bus.seq + 1, timestamp or time.time(), image, self.gray, self.markers, self.faces, self.overlay
+        )
+        self.bus.publish(self.snapshot, self.snapshot.timestamp)
+
+    def stage_frame(self, name):
+        # Async stages outlive several frames of the gray ring, so they get a private copy.
+        # One buffer per stage is enough: a stage only gets a new frame once its last run is done
+        buffer = self.stage_pools.setdefault(name, BufferPool(1)).next(self.gray.shape)
+        np.copyto(buffer, self.gray)
+        return buffer
+
+    def process(self, frame, timestamp=None):
+        frame = self.flip(frame)
+        with metrics.timer('stage_seconds', stage='gray'):
+            self.gray = self.to_gray(frame)
+        # A stage that skips a frame (rate limit / busy) still has to see the change, so it stays pending
+        if self.active and self.detection_due(): self.pending = set(self.active)
+        for name in self.pending & self.active:
+            if not self.scheduler.due(name): continue
+            self.scheduler.submit(name, self.detectors[name], self.stage_frame(name))
+            self.pending.discard(name)
+        # Runs are read before results: a run finishing in between gets processed again, never skipped
+        runs = {name: stage.runs for name, stage in self.scheduler.stages.items()}
+        if 'markers' in self.active:
+            markers = self.scheduler.result('markers')
+            if markers is not None: self.process_markers(markers, runs['markers'])
+        self.process_faces(self.scheduler.result('faces') if 'faces' in self.active else None, runs['faces'])
+        self.scheduler.run('overlay', self.draw)
+        self.publish(frame, timestamp)
+
+    def process_parallel(self, frame, timestamp=None):
+        # Detectors and encoder run in worker processes over shared memory frame rings,
+        # results of the newest processed frame are applied to the current one
+        frame = self.flip(frame)
+        if self.pipeline is None: self.start_pipeline(frame.shape)
+        self.gray = self.to_gray(frame)
+        if self.active and self.detection_due():
+            np.copyto(self.pipeline.gray.claim(), self.gray)
+            self.pipeline.gray.publish()
+
+        results = self.pipeline.collect()
+        self.timings.update(self.pipeline.timings)
+        # Missing results (disabled, dead or stuck worker) mean no markers and no face check: disarmed
+        if 'markers' in results and 'markers' in self.active: self.process_markers(results['markers'][1], results['markers'][0])
+        else: self.clear_markers()
+        if 'faces' in results and 'faces' in self.active: self.process_faces(results['faces'][1], results['faces'][0])
+        else: self.process_faces(None)
+        if 'encoder' in results: self.jpeg = results['encoder']
+
+        self.scheduler.run('overlay', self.draw)
+        if self.server.watched(Server.PIPELINE_FEED):  # Other streams are encoded by the server
+            self.overlay.apply(self.gray, dst=self.pipeline.frames.claim())
+            self.pipeline.frames.publish()
+        self.publish(frame, timestamp)
 
     def stop(self):
         self.stopped = True
-        self.event.set()
+        self.subscription.close()
         self.join()
 
     def run(self):
@@ -142,19 +352,15 @@ class Core(BaseStream):
         self.server.start()
 
         while not self.stopped:
-            self.event.wait()
-            if self.stopped: break
-            self.event.clear()
+            item = self.subscription.next()
+            if item is None: break
 
-            frame = self.stream.frame
+            _, timestamp, frame = item
             if frame is None: continue
-            if FLIP is not None: frame = cv2.flip(frame, FLIP)
-            self.gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            self.frame = cv2.cvtColor(self.gray, cv2.COLOR_GRAY2BGR)
-
-            self.process_markers()
-            self.process_faces()
-            self.notify()
+            metrics.observe('frame_age_seconds', time.time() - timestamp, stage='capture')
+            with metrics.timer('stage_seconds', stage='core'):
+                if PIPELINE == 'process': self.process_parallel(frame, timestamp)
+                else: self.process(frame, timestamp)
 
         print('[CORE] STOPPING STREAM THREAD...')
         self.stream.stop()
@@ -164,71 +370,81 @@ class Core(BaseStream):
         self.server.stop()
         print('[CORE] STOPPING HANDLER THREAD...')
         if self.handler: self.handler.stop()
+        self.executor.shutdown()
+        if self.pipeline:
+            print('[CORE] STOPPING PIPELINE PROCESSES...')
+            self.pipeline.stop()
         print('[CORE] TERMINATED')
 
 
 class BaseHandler(Thread):
     name = 'Base Handler'
+    detectors = ()  # Core detectors the handler needs
+
+    THRESHOLD = 1  # steps
 
     def __init__(self, core):
         super().__init__()
         self.core = core
         self.motion = self.core.motion
-        self.event = self.core.subscribe()
+        self.subscription = self.core.subscribe()
+        self.tracker = TargetTracker(self.motion, self.core.camera_matrix, TRACKING_LEAD)
+        self.snapshot = None   # Core results of the frame being handled
+        self.timestamp = None  # Capture time of the frame being handled
         self.stopped = False
 
     def stop(self):
         self.stopped = True
-        self.event.set()
+        self.subscription.close()
         self.join()
 
     def run(self):
         while not self.stopped:
-            self.event.wait()
-            if self.stopped: break
-            self.event.clear()
-            self.handle()
+            item = self.subscription.next()
+            if item is None: break
+
+            # Commands issued while handling are tagged with the frame capture time
+            self.snapshot = item[2]
+            self.timestamp = self.motion.timestamp = item[1]
+            with metrics.timer('stage_seconds', stage='handler'):
+                self.handle()
+            self.motion.timestamp = None
 
     def handle(self): pass
 
+    def follow(self, key, x):
+        # Aims at the predicted target position, returns the remaining error (steps)
+        self.tracker.update(key, x, self.timestamp)
+        error = self.tracker.error(key)
+        if abs(error) >= self.THRESHOLD: self.motion.move_to(self.tracker.aim(key))
+        return error
+
 
 class MarkerTrackingHandler(BaseHandler):
     name = 'Marker Tracker'
-
-    THRESHOLD = 10  # px
-    RATIO = 15      # steps
+    detectors = ('markers',)
 
     def handle(self):
-        if not self.core.markers: return
-        marker = self.core.markers[0]
-        x = marker['center'][0]
-        delta = x - WIDTH // 2
-        if abs(delta) < self.THRESHOLD: return
-        steps = (delta / (WIDTH / 2)) * self.RATIO
-        self.motion.step(steps)
+        markers = self.snapshot.markers
+        if not markers: return
+        self.follow(int(markers.ids[0]), markers.centers[0][0])
 
 
 class FaceTrackingHandler(BaseHandler):
     name = 'Face Tracker'
-
-    THRESHOLD = 10
-    RATIO = 15
+    detectors = ('faces',)
 
     def handle(self):
-        if not self.core.faces: return
-        face = self.core.faces[0]
-        x = face[0] + face[2]
-        delta = x - WIDTH // 2
-        if abs(delta) < self.THRESHOLD: return
-        steps = (delta / (WIDTH / 2)) * self.RATIO
-        self.motion.step(steps)
+        if not self.snapshot.faces: return
+        x, _, w, _ = self.snapshot.faces[0]
+        self.follow('face', x + w / 2)
 
 
 class BattleHandler(BaseHandler):
     name = 'BATTLE HANDLER'
+    detectors = ('markers', 'faces')  # Faces keep the turret disarmed
 
-    OFFSET = 10
-    THRESHOLD = 5
+    OFFSET = 10     # px
     CHARGE_TIME = 3
 
     def __init__(self, core):
@@ -238,18 +454,21 @@ class BattleHandler(BaseHandler):
         self.direction = 1
 
     def handle(self):
-        if self.core.markers:
+        markers = self.snapshot.markers
+        targets = [i for i in range(len(markers)) if markers.ids[i] not in self.eliminated]
+        if targets:
             self.motion.slowmode = False
-            markers = self.core.markers.copy()
-            markers = list(filter(lambda x: x['id'] not in self.eliminated, markers))
-            markers.sort(key=lambda x: x['id'])
-            target = markers[0]
-            delta = target['center'][0] - (WIDTH // 2 + self.OFFSET)
+            # Closest target first (lowest id if poses are not estimated)
+            priority = markers.distances if markers.distances is not None else markers.ids
+            target = min(targets, key=lambda i: priority[i])
+            target_id = int(markers.ids[target])
+            # Barrel points OFFSET px right of the frame center
+            error = self.follow(target_id, markers.centers[target][0] - self.OFFSET)
             now = time.time()
-            if abs(delta) <= self.THRESHOLD:
+            if abs(error) <= self.THRESHOLD:
                 if now - self.last_shot < self.CHARGE_TIME: return
                 self.last_shot = now
-                self.eliminated.append(target['id'])
+                self.eliminated.append(target_id)
                 print('FIRE!!!')
                 # self.motion.fire()
                 return
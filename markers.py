@@ -0,0 +1,58 @@
+import numpy as np
+import cv2
+
+__all__ = [
+    'Markers',
+]
+
+
+class Markers:
+    # All markers of a frame as contiguous arrays, index i is the same marker everywhere
+    def __init__(self, ids=None, corners=None):
+        self.ids = np.empty(0, np.int32) if ids is None else ids               # (N,)
+        self.corners = np.empty((0, 4, 2), np.float32) if corners is None else corners  # (N, 4, 2) px
+        self.centers = self.corners.mean(axis=1)                               # (N, 2) px
+        self.rvecs = None                                                      # (N, 3) rodrigues
+        self.tvecs = None                                                      # (N, 3) marker length units
+
+    @classmethod
+    def from_detection(cls, corners, ids):
+        # cv2.aruco.detectMarkers output -> Markers
+        if ids is None or not len(ids): return cls()
+        return cls(ids.reshape(-1).astype(np.int32), np.asarray(corners, np.float32).reshape(-1, 4, 2))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __bool__(self):
+        return len(self.ids) > 0
+
+    @property
+    def distances(self):
+        # Distance to every marker (None until estimate_pose)
+        if self.tvecs is None: return None
+        return np.linalg.norm(self.tvecs, axis=1)
+
+    def estimate_pose(self, length, matrix, distortion):
+        # One batched call for all markers
+        if not self: return
+        rvecs, tvecs, _ = cv2.aruco.estimatePoseSingleMarkers(self.corners[:, None], length, matrix, distortion)
+        self.rvecs, self.tvecs = rvecs.reshape(-1, 3), tvecs.reshape(-1, 3)
+
+    def undistort(self, matrix, distortion):
+        # Centers without lens distortion (same pixel coordinates, one batched call) for aiming.
+        # Corners stay as detected, they are drawn onto the distorted frame
+        if not self: return
+        points = cv2.undistortPoints(self.corners.reshape(-1, 1, 2), matrix, distortion, P=matrix)
+        self.centers = points.reshape(-1, 4, 2).mean(axis=1)
+
+    def to_json(self):
+        # Only converted when somebody asks (e.g. /status)
+        data = [{
+            'id': int(self.ids[i]),
+            'corners': self.corners[i].astype(int).tolist(),
+            'center': self.centers[i].astype(int).tolist(),
+        } for i in range(len(self))]
+        if self.tvecs is not None:
+            for i, distance in zip(data, self.distances): i['distance'] = round(float(distance), 1)
+        return data
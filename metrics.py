@@ -0,0 +1,80 @@
+from contextlib import contextmanager
+from bisect import bisect_left
+import time
+
+__all__ = [
+    'Histogram',
+    'Metrics',
+    'metrics',
+]
+
+BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)  # Seconds
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    PREFIX = 'turret_'
+
+    def __init__(self):
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.counters = {}    # (name, labels) -> value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None: histogram = self.histograms.setdefault(key, Histogram())
+        histogram.observe(value)
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try: yield
+        finally: self.observe(name, time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def labels(pairs):
+        if not pairs: return ''
+        return '{%s}' % ','.join('%s="%s"' % pair for pair in pairs)
+
+    def render(self):
+        # Prometheus text exposition format
+        counters = sorted(list(self.counters.items()))
+        histograms = sorted(list(self.histograms.items()), key=lambda x: x[0])
+        lines = []
+
+        for name in sorted({name for (name, _), _ in counters}):
+            lines.append('# TYPE %s%s counter' % (self.PREFIX, name))
+            for (key, labels), value in counters:
+                if key == name: lines.append('%s%s%s %s' % (self.PREFIX, name, self.labels(labels), value))
+
+        for name in sorted({name for (name, _), _ in histograms}):
+            lines.append('# TYPE %s%s histogram' % (self.PREFIX, name))
+            for (key, labels), histogram in histograms:
+                if key != name: continue
+                total = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    total += count
+                    lines.append('%s%s_bucket%s %s' % (self.PREFIX, name, self.labels(labels + (('le', bound),)), total))
+                lines.append('%s%s_sum%s %s' % (self.PREFIX, name, self.labels(labels), histogram.sum))
+                lines.append('%s%s_count%s %s' % (self.PREFIX, name, self.labels(labels), histogram.count))
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()  # Shared by all threads
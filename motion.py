@@ -7,15 +7,64 @@ try: import OPi.GPIO as GPIO
 except ImportError: pass
 
 from threading import Thread, Event, Timer
-from math import copysign
-from time import sleep
+from time import sleep, perf_counter
+from collections import deque
+from metrics import metrics
+from math import copysign, sqrt
+import time
+import os
+
+
+class PulseTimer:
+    def __init__(self, spin=0.002):
+        self.spin = spin        # Spin (yielding) the last part of every interval (seconds)
+        self.deadline = None    # Next pulse time (perf_counter)
+        self.pulses = 0
+        self.overruns = 0       # Pulses that were more than two periods late (schedule restarted from now)
+        self.jitter = 0         # Last pulse lateness (seconds)
+        self.max_jitter = 0
+        self.total_jitter = 0
+
+    def reset(self):
+        # Next pulse goes out immediately, e.g. after an idle period
+        self.deadline = None
+
+    def pulse(self, pin, period):
+        # Deadlines are absolute (previous deadline + period), so sleep errors never accumulate
+        now = perf_counter()
+        if self.deadline is None: self.deadline = now
+        elif now - self.deadline > 2 * period: self.deadline = now; self.overruns += 1
+        else: self.deadline += period
+
+        remaining = self.deadline - perf_counter() - self.spin
+        if remaining > 0: sleep(remaining)
+        while perf_counter() < self.deadline: sleep(0)  # Yields the GIL, vision threads keep running
+        pin(True)
+
+        self.jitter = perf_counter() - self.deadline
+        self.max_jitter = max(self.max_jitter, self.jitter)
+        self.total_jitter += self.jitter
+        self.pulses += 1
+        metrics.observe('step_jitter_seconds', self.jitter)
+
+    def status(self):
+        return {
+            'last': self.jitter,
+            'max': self.max_jitter,
+            'mean': self.total_jitter / self.pulses if self.pulses else 0,
+            'pulses': self.pulses,
+            'overruns': self.overruns,
+        }
 
 
 class BaseMotion(Thread):
+    SEGMENT = 32  # Max steps planned ahead at once (commands are picked up between steps anyway)
+
     def __init__(self, params):
         super().__init__()
         self.speed = params['SPEED']
         self.slowspeed = params['SLOWSPEED']
+        self.acceleration = params['ACCELERATION']
         self.reverse = params['REVERSE']
         self.revolution = params['REVOLUTION']
         self.rotation_range = params['ROTATION_RANGE']
@@ -25,6 +74,8 @@ class BaseMotion(Thread):
         self.min_pwm = params['MIN_PWM']
         self.max_pwm = params['MAX_PWM']
         self.pwm_range = self.max_pwm - self.min_pwm
+        self.realtime = params['REALTIME']
+        self.timer = PulseTimer(params['SPIN_TIME'])
 
         self.enable_pin = lambda x: None
         self.step_pin = lambda x: None
@@ -40,11 +91,24 @@ class BaseMotion(Thread):
         self.sleep.set()
         self.abs_rotation = 0
         self.rotation = 0
+        self.velocity = 0              # Current step rate (steps per second, signed like rotation)
         self.angle = 0
-        self.update = self.sleep.set
+        self.timestamp = None          # Capture time of the frame the current command is based on
+        self.command_timestamp = None  # Same for the command being executed (until its first step)
+        self.listeners = []            # Called (from the motion thread) when motion state changes
+        self.history = deque(maxlen=256)  # (time, abs_rotation) after recent steps
+        self.commands = 0              # Bumped on every command, a planned schedule is dropped then
+
+    def update(self):
+        self.commands += 1
+        self.sleep.set()
+
+    def changed(self):
+        for listener in self.listeners: listener()
 
     def rotate(self, value):
         self.rotation = value
+        self.command_timestamp = self.timestamp
         self.update()
 
     def step(self, value):
@@ -52,6 +116,49 @@ class BaseMotion(Thread):
         rotation = value / self.revolution
         self.rotate(rotation)
 
+    def position_at(self, timestamp):
+        # Where the turret was at given time (e.g. when a frame was captured)
+        for step_time, position in reversed(list(self.history)):
+            if step_time <= timestamp: return position
+        return self.history[0][1] if self.history else self.abs_rotation
+
+    def move_to(self, position):
+        # Absolute target (same units as abs_rotation), blended into the motion in progress
+        self.rotate(self.abs_rotation - position)
+
+    def distance(self):
+        # Steps left to the target, which is clamped to the rotation range
+        target = self.abs_rotation - self.rotation
+        if self.rotation_range: target = min(max(target, -self.rotation_range), self.rotation_range)
+        return (self.abs_rotation - target) * self.revolution
+
+    def plan(self, distance, velocity):
+        # Trapezoidal profile: speed for the next step (signed, steps per second), 0 = stop here
+        top = self.speed if not self.slowmode else self.slowspeed
+        start = min(sqrt(2 * self.acceleration), top)  # Speed reachable within one step from standstill
+        speed = abs(velocity)
+        ahead = velocity and copysign(1, distance) == copysign(1, velocity)
+        cruise = ahead and abs(distance) - 1 > speed ** 2 / (2 * self.acceleration)
+
+        limit = top if cruise else 0
+        if speed < limit: speed = min(sqrt(speed ** 2 + 2 * self.acceleration), limit)
+        else: speed = max(sqrt(max(speed ** 2 - 2 * self.acceleration, 0)), limit)
+        if speed >= start: return copysign(speed, velocity)
+
+        # Slow enough to stop or turn around right away
+        if abs(distance) < 0.5: return 0
+        return copysign(start, distance)
+
+    def schedule(self, distance):
+        # Step speeds of the next segment of the move, planned at once so pulses go out back to back
+        speeds, velocity = [], self.velocity
+        while len(speeds) < self.SEGMENT:
+            velocity = self.plan(distance, velocity)
+            if not velocity: break
+            speeds.append(velocity)
+            distance -= copysign(1, velocity)
+        return speeds
+
     def fire(self):
         if not self.armed: return
         self.fire_pin(True)
@@ -63,7 +170,14 @@ class BaseMotion(Thread):
         self.sleep.set()
         self.join()
 
+    @staticmethod
+    def set_realtime():
+        # Linux only, needs root: vision threads can't delay steps anymore
+        try: os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(os.sched_get_priority_max(os.SCHED_FIFO) // 2))
+        except (AttributeError, OSError): print('[M] REALTIME PRIORITY UNAVAILABLE')
+
     def run(self):
+        if self.realtime: self.set_realtime()
         while not self.stopped:
             if not self.sleep.is_set():
                 self.sleep.wait(self.sleep_timeout)
@@ -75,24 +189,40 @@ class BaseMotion(Thread):
             self.enable_pin(False)
             self.step_pin(False)
             self.pwm_pin(self.min_pwm + self.angle * self.pwm_range)
-            self.dir_pin((self.rotation > 0) ^ self.reverse)
 
-            if abs(self.rotation) < 1 / self.revolution:
-                self.rotation = 0
+            speeds = self.schedule(self.distance())
+            if not speeds:
+                # Target reached, or it's beyond the rotation range and we stopped at the border
+                self.velocity = 0
+                self.onborder = bool(self.rotation_range) and abs(self.rotation) >= 1 / self.revolution
+                if not self.onborder: self.rotation = 0
                 self.sleep.clear()
+                self.timer.reset()
+                self.changed()
                 continue
 
-            delta = copysign(1 / self.revolution, self.rotation)
-            if self.rotation_range and abs(self.abs_rotation - delta) > self.rotation_range:
-                self.onborder = True
-                continue
+            commands = self.commands
+            for speed in speeds:
+                if self.stopped or self.commands != commands: break  # New target, replanned from the current speed
+                delta = copysign(1 / self.revolution, speed)
+                self.dir_pin((delta > 0) ^ self.reverse)
+                if self.rotation_range and abs(self.abs_rotation - delta) > self.rotation_range:
+                    self.velocity = 0
+                    if not self.onborder: self.onborder = True; self.changed()
+                    self.sleep.clear()
+                    break
 
-            self.onborder = False
-            self.rotation -= delta
-            self.abs_rotation -= delta
-            self.step_pin(True)
-            speed = self.speed if not self.slowmode else self.slowspeed
-            sleep(1 / speed)
+                self.onborder = False
+                self.velocity = speed
+                self.timer.pulse(self.step_pin, 1 / abs(speed))
+                self.rotation -= delta
+                self.abs_rotation -= delta
+                self.history.append((time.time(), self.abs_rotation))
+                metrics.count('motion_steps_total')
+                if self.command_timestamp is not None:
+                    metrics.observe('glass_to_motor_seconds', time.time() - self.command_timestamp)
+                    self.command_timestamp = None
+                self.changed()
 
 
 class FakeMotion(BaseMotion):
@@ -105,6 +235,20 @@ class FakeMotion(BaseMotion):
         self.fire_pin = lambda x: x and print('[M] <<< FIRE >>>')
 
 
+class SimMotion(BaseMotion):
+    def __init__(self, _, params):
+        super().__init__(params)
+        self.direction = False
+        self.pulses = deque(maxlen=10000)  # (perf_counter, direction) of every step pulse
+        self.dir_pin = lambda x: setattr(self, 'direction', x)
+        self.step_pin = lambda x: x and self.pulses.append((perf_counter(), self.direction))
+        self.fire_pin = lambda x: x and print('[M] <<< FIRE >>>')
+
+    def intervals(self):
+        times = [i[0] for i in self.pulses]
+        return [b - a for a, b in zip(times, times[1:])]
+
+
 class OPiMotion(BaseMotion):
     def __init__(self, pins, params):
         super().__init__(params)
@@ -0,0 +1,26 @@
+import numpy as np
+import cv2
+
+__all__ = [
+    'Overlay',
+]
+
+
+class Overlay:
+    # Annotations of a frame kept as shapes, drawn only when an annotated stream is encoded
+    def __init__(self, corners=None, faces=(), text=None, color=None, style=None):
+        self.corners = np.empty((0, 4, 2), np.float32) if corners is None else corners  # (N, 4, 2) marker corners
+        self.faces = faces                                                               # [(x, y, w, h)]
+        self.text = text
+        self.color = color
+        self.style = style or {}  # cv2.putText params (org, fontFace, fontScale)
+
+    def apply(self, gray, scale=1, dst=None):
+        # Single channel frame (scaled down by given factor) -> annotated BGR frame
+        frame = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR, dst=dst)
+        if len(self.corners): cv2.aruco.drawDetectedMarkers(frame, self.corners[:, None] * scale, borderColor=(0, 0, 255))
+        for face in self.faces:
+            x, y, w, h = (round(i * scale) for i in face)
+            cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 1)
+        if self.text: cv2.putText(frame, self.text, color=self.color, thickness=1, **self.style)
+        return frame
@@ -0,0 +1,145 @@
+import multiprocessing as mp
+from detectors import synthetic_frame
+from queue import Empty
+import numpy as np
+import ctypes
+import time
+import cv2
+
+__all__ = [
+    'FrameRing',
+    'Worker',
+    'Pipeline',
+    'jpeg_encoder',
+]
+
+# Spawned children don't inherit server / camera threads state
+context = mp.get_context('spawn')
+
+
+class FrameRing:
+    def __init__(self, shape, slots=4):
+        self.shape = tuple(shape)
+        self.slots = slots
+        self.buffers = [context.RawArray(ctypes.c_uint8, int(np.prod(shape))) for _ in range(slots)]
+        self.seq = context.Value(ctypes.c_int64, 0, lock=False)  # Last published frame (0 = none yet)
+        self.wakeups = []  # Semaphore per consumer: releasing never blocks, unlike Condition.notify_all
+        self.views = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['views'] = None  # Numpy views are rebuilt in every process
+        return state
+
+    def view(self, seq):
+        if self.views is None:
+            self.views = [np.frombuffer(i, np.uint8).reshape(self.shape) for i in self.buffers]
+        return self.views[seq % self.slots]
+
+    def claim(self):
+        # Slot for the next frame, write directly into it (e.g. as OpenCV dst) and publish
+        return self.view(self.seq.value + 1)
+
+    def subscribe(self):
+        # Wakeup for one consumer process, has to be created before the consumer is started
+        wakeup = context.Semaphore(0)
+        self.wakeups.append(wakeup)
+        return wakeup
+
+    def publish(self):
+        # Never waits for consumers, a dead or busy one just has its wakeups piling up
+        self.seq.value += 1
+        for wakeup in self.wakeups: wakeup.release()
+        return self.seq.value
+
+    def wait(self, seq, wakeup, timeout=None):
+        if self.seq.value <= seq: wakeup.acquire(timeout=timeout)
+        while wakeup.acquire(False): pass  # Skipped frames
+        return self.seq.value
+
+    def valid(self, seq):
+        # False if the producer has already started overwriting this frame slot
+        return self.seq.value + 1 - seq < self.slots
+
+
+class Worker(context.Process):
+    def __init__(self, name, ring, results, factory, params):
+        super().__init__(name=name, daemon=True)
+        self.ring = ring
+        self.results = results
+        self.factory = factory
+        self.params = params
+        self.wakeup = ring.subscribe()
+        self.stopped = context.Event()
+        self.enabled = context.Event()
+        self.enabled.set()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.release()
+        self.join(1)
+        if self.is_alive(): self.terminate()
+
+    def run(self):
+        process = self.factory(**self.params)
+        process(synthetic_frame(self.ring.shape))  # Warm up before the first real frame
+        seq = 0
+        while not self.stopped.is_set():
+            if not self.enabled.wait(0.5): continue
+            latest = self.ring.wait(seq, self.wakeup, 0.5)
+            if latest == seq: continue
+            seq = latest
+
+            start = time.time()
+            result = process(self.ring.view(seq))
+            if not self.ring.valid(seq): continue  # Torn frame, drop the result
+            self.results.put((self.name, seq, result, time.time() - start))
+
+
+class Pipeline:
+    def __init__(self, shape, slots=4, max_age=2):
+        self.gray = FrameRing(shape[:2], slots)
+        self.frames = FrameRing(tuple(shape[:2]) + (3,), slots)
+        self.results = context.Queue()
+        self.workers = {}  # Name -> Worker
+        self.latest = {}   # Worker name -> (seq, result)
+        self.received = {} # Worker name -> time the latest result came in
+        self.timings = {}  # Worker name -> last processing time (seconds)
+        self.max_age = max_age  # Results older than this (seconds) are dropped, e.g. of a stuck worker
+
+    def add(self, name, ring, factory, **params):
+        self.workers[name] = Worker(name, ring, self.results, factory, params)
+
+    def enable(self, name, enabled=True):
+        # Disabled workers sleep, their last result is forgotten
+        if enabled: self.workers[name].enabled.set()
+        else: self.workers[name].enabled.clear()
+        self.latest.pop(name, None)
+
+    def start(self):
+        for worker in self.workers.values(): worker.start()
+
+    def stop(self):
+        for worker in self.workers.values(): worker.stop()
+
+    def collect(self):
+        # Drains the result channel without blocking, keeps only the newest result per worker
+        while True:
+            try: name, seq, result, elapsed = self.results.get_nowait()
+            except Empty: break
+            if not self.workers[name].enabled.is_set(): continue
+            if seq < self.latest.get(name, (0, None))[0]: continue
+            self.latest[name] = (seq, result)
+            self.received[name] = time.time()
+            self.timings[name] = elapsed
+
+        # A dead or stuck worker has no result rather than a stale one
+        now = time.time()
+        for name in list(self.latest):
+            if not self.workers[name].is_alive() or now - self.received[name] > self.max_age:
+                del self.latest[name]
+        return self.latest
+
+
+def jpeg_encoder(quality=95):
+    return lambda frame: cv2.imencode('.jpg', frame, (cv2.IMWRITE_JPEG_QUALITY, quality))[1].tobytes()
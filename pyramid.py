@@ -0,0 +1,42 @@
+import numpy as np
+import cv2
+
+__all__ = [
+    'downscale',
+    'upscale_corners',
+    'upscale_rects',
+    'refine_corners',
+]
+
+REFINE_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+
+
+def downscale(gray, scale, dst=None):
+    # Detection image (scale = 1 returns the frame itself)
+    if scale == 1: return gray
+    size = (round(gray.shape[1] * scale), round(gray.shape[0] * scale))
+    return cv2.resize(gray, size, dst=dst, interpolation=cv2.INTER_AREA)
+
+
+def upscale_corners(corners, scale):
+    # detectMarkers corners from the detection image -> (N, 4, 2) full resolution px
+    if not len(corners): return np.empty((0, 4, 2), np.float32)
+    corners = np.asarray(corners, np.float32).reshape(-1, 4, 2)
+    if scale == 1: return corners
+    return (corners + 0.5) / scale - 0.5  # Pixel centers, not edges, are mapped
+
+
+def upscale_rects(rects, scale):
+    # (x, y, w, h) rects from the detection image -> full resolution
+    if scale == 1 or not len(rects): return rects
+    return np.round(np.asarray(rects) / scale).astype(int)
+
+
+def refine_corners(gray, corners, scale):
+    # Sub-pixel corner positions in the full resolution frame, the search window covers the
+    # position error of the detection image (cornerSubPix only looks at a small area around every corner)
+    if not len(corners): return corners
+    window = max(int(np.ceil(1 / scale)) + 1, 2)
+    points = corners.reshape(-1, 1, 2).copy()
+    cv2.cornerSubPix(gray, points, (window, window), (-1, -1), REFINE_CRITERIA)
+    return points.reshape(-1, 4, 2)
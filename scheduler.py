@@ -0,0 +1,111 @@
+from threading import Lock
+from metrics import metrics
+import time
+
+__all__ = [
+    'Stage',
+    'Scheduler',
+]
+
+
+class Stage:
+    def __init__(self, name, fps=None, timeout=None):
+        self.name = name
+        self.fps = fps          # Target rate (None = every frame)
+        self.timeout = timeout  # Max result age before the caller waits for it (None = never wait)
+        self.future = None
+        self.result = None
+        self.started = 0        # Last run start time
+        self.finished = 0       # Last result time
+        self.time = 0           # Last run duration (seconds)
+        self.rate = 0           # Effective rate (fps, smoothed)
+        self.runs = 0
+        self.skips = 0          # Frames skipped to keep the target rate
+        self.drops = 0          # Frames dropped because the stage was still busy
+        self.generation = 0     # Bumped by reset, results of older runs are ignored
+
+    def status(self):
+        return {
+            'fps': round(self.rate, 2),
+            'target': self.fps,
+            'time': self.time,
+            'runs': self.runs,
+            'skips': self.skips,
+            'drops': self.drops,
+        }
+
+
+class Scheduler:
+    SMOOTHING = 0.1  # Effective rate EMA factor
+
+    def __init__(self, executor=None):
+        self.executor = executor
+        self.stages = {}
+        self.timings = {}  # Stage name -> last run duration (seconds)
+        self.lock = Lock()
+
+    def add(self, name, fps=None, timeout=None):
+        self.stages[name] = Stage(name, fps, timeout)
+
+    def due(self, name):
+        # Stages always work on the latest frame: a busy stage drops it instead of queueing
+        stage = self.stages[name]
+        if stage.future is not None and not stage.future.done():
+            stage.drops += 1
+            metrics.count('stage_drops_total', stage=name)
+            return False
+        if stage.fps and time.time() - stage.started < 1 / stage.fps:
+            stage.skips += 1
+            metrics.count('stage_skips_total', stage=name)
+            return False
+        return True
+
+    def call(self, stage, func, *args):
+        generation = stage.generation
+        start = time.time()
+        result = func(*args)
+        now = time.time()
+        with self.lock:
+            if generation != stage.generation: return result
+            if stage.finished: stage.rate += (1 / max(now - stage.finished, 1e-6) - stage.rate) * self.SMOOTHING
+            stage.result = result
+            stage.finished = now
+            stage.time = self.timings[stage.name] = now - start
+            stage.runs += 1
+        metrics.observe('stage_seconds', stage.time, stage=stage.name)
+        return result
+
+    def run(self, name, func, *args):
+        # Runs the stage in the calling thread (if due), returns True if it ran
+        if not self.due(name): return False
+        stage = self.stages[name]
+        stage.started = time.time()
+        self.call(stage, func, *args)
+        return True
+
+    def submit(self, name, func, *args):
+        # Runs the stage on the executor (if due), returns True if it was submitted
+        if not self.due(name): return False
+        stage = self.stages[name]
+        stage.started = time.time()
+        stage.future = self.executor.submit(self.call, stage, func, *args)
+        return True
+
+    def result(self, name):
+        # Latest result, waits for the running stage only if the result is older than stage timeout
+        stage = self.stages[name]
+        future = stage.future
+        if future is not None and stage.timeout is not None and time.time() - stage.finished >= stage.timeout:
+            future.result()
+        return stage.result
+
+    def reset(self, name):
+        # Forgets the stage result, a run that is still going finishes but its result is ignored
+        stage = self.stages[name]
+        with self.lock:
+            stage.generation += 1
+            stage.result = None
+            stage.finished = 0
+
+    def status(self):
+        return {name: stage.status() for name, stage in self.stages.items()}
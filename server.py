@@ -1,68 +1,325 @@
+from metrics import metrics
+from stream import BufferPool
 from threading import Thread
-from aiohttp import web
+from aiohttp import web, WSMsgType
 import asyncio
+import socket
+import json
+import time
 import cv2
 
 
+class Encoder(Thread):
+    def __init__(self, server):
+        super().__init__()
+        self.server = server
+        self.core = server.core
+        self.subscription = self.core.subscribe()
+        self.stopped = False
+        self.jpegs = {}               # Feed key -> last encoded frame
+        self.pools = {}               # (overlay, scale) -> image buffer
+
+    def stop(self):
+        self.stopped = True
+        self.subscription.close()
+        self.join()
+
+    def run(self):
+        # Frame waiting and encoding happen here, away from the event loop.
+        # Only feeds somebody is watching are encoded
+        seq, camera_seq, last = 0, 0, 0
+        while not self.stopped:
+            item = self.subscription.next()
+            if item is None: break
+            self.server.changed()
+
+            frame_seq, timestamp, snapshot = item
+            wanted = [key for key, feed in list(self.server.feeds.items()) if feed.clients]
+            if not wanted: continue  # Nobody watching, nothing to encode or forward
+            if self.core.pipeline and self.server.PIPELINE_FEED in wanted:
+                # Already encoded by the pipeline encoder process
+                wanted.remove(self.server.PIPELINE_FEED)
+                if self.core.jpeg is not None and self.core.jpeg[0] != seq:
+                    seq, jpeg = self.core.jpeg
+                    self.server.loop.call_soon_threadsafe(self.server.publish, self.server.PIPELINE_FEED, jpeg, timestamp)
+
+            camera = self.core.camera and self.core.camera.jpeg
+            if camera is not None and self.server.CAMERA_FEED in wanted:
+                # Raw frames as the camera encoded them
+                wanted.remove(self.server.CAMERA_FEED)
+                if camera[0] != camera_seq:
+                    camera_seq, jpeg, camera_timestamp = camera
+                    self.server.loop.call_soon_threadsafe(self.server.publish, self.server.CAMERA_FEED, jpeg, camera_timestamp)
+
+            # Bus seq, not object identity: pooled buffers come back with new content
+            if not wanted or snapshot is None or frame_seq == last: continue
+            if not self.core.scheduler.run('encode', self.encode, snapshot, wanted): continue
+            last = frame_seq
+            for key, jpeg in self.jpegs.items():
+                self.server.loop.call_soon_threadsafe(self.server.publish, key, jpeg, timestamp)
+
+    def buffer(self, key, shape):
+        return self.pools.setdefault(key, BufferPool(1)).next(shape)
+
+    def image(self, snapshot, overlay, scale):
+        # Overlays of the same snapshot, so shapes always match the image
+        frame = snapshot.gray
+        if scale != 1:
+            size = (round(frame.shape[1] * scale), round(frame.shape[0] * scale))
+            frame = cv2.resize(frame, size, dst=self.buffer((False, scale), size[::-1]), interpolation=cv2.INTER_AREA)
+        if not overlay: return frame  # Single channel JPEG
+        return snapshot.overlay.apply(frame, scale, dst=self.buffer((True, scale), frame.shape[:2] + (3,)))
+
+    def encode(self, snapshot, keys):
+        # Every image variant is made once, every feed is encoded once no matter how many clients watch it
+        self.jpegs = {}
+        images = {}
+        for overlay, quality, scale in keys:
+            image = images.get((overlay, scale))
+            if image is None: image = images[(overlay, scale)] = self.image(snapshot, overlay, scale)
+            self.jpegs[(overlay, quality, scale)] = cv2.imencode('.jpg', image, (cv2.IMWRITE_JPEG_QUALITY, quality))[1].tobytes()
+
+
+class Feed:
+    # Latest encoded frame of one stream variant (overlay, quality, scale), shared by all its clients
+    def __init__(self, loop):
+        self.loop = loop
+        self.jpeg = None
+        self.timestamp = None  # Capture time
+        self.version = 0       # Encoded frame counter
+        self.waiter = loop.create_future()  # Resolved on every new encoded frame
+        self.clients = 0       # Connected /stream clients
+
+    def publish(self, jpeg, timestamp):
+        self.jpeg = jpeg
+        self.timestamp = timestamp
+        self.version += 1
+        waiter, self.waiter = self.waiter, self.loop.create_future()
+        waiter.set_result(self.version)
+
+    def close(self):
+        if not self.waiter.done(): self.waiter.set_result(self.version)
+
+
+class Client:
+    # One /stream connection. Quality goes down while its writes back up and recovers when they don't
+    SMOOTHING = 0.2  # Write time EMA factor
+
+    def __init__(self, server, query):
+        self.server = server
+        levels = server.QUALITY_LEVELS
+        quality = int(query.get('quality', levels[0]))
+        scale = float(query.get('scale', 1))
+        fps = float(query.get('fps', 0))
+        if not 1 <= quality <= 100: raise ValueError('quality must be 1..100')
+        if not 0 < scale <= 1: raise ValueError('scale must be in (0, 1]')
+        if fps < 0: raise ValueError('fps must not be negative')
+        overlay = query.get('overlay')
+        if overlay == 'camera' and server.core.camera is None: raise ValueError('no camera encoded stream available')
+        # Snapped to shared levels, so clients asking for similar streams share encodes
+        self.overlay = overlay if overlay == 'camera' else overlay != '0'
+        self.requested = min(range(len(levels)), key=lambda i: abs(levels[i] - quality))
+        self.level = self.requested
+        self.scale = min(server.SCALES, key=lambda x: abs(x - scale))
+        self.interval = 1 / fps if fps else 0  # Min time between frames (seconds)
+        self.write_time = 0                    # Frame write time (seconds, smoothed)
+        self.frames = 0                        # Frames since the last quality change
+        self.feed = None                       # Feed being watched
+
+    @property
+    def key(self):
+        if self.overlay == 'camera': return self.server.CAMERA_FEED  # Fixed quality and scale, nothing to adapt
+        return self.overlay, self.server.QUALITY_LEVELS[self.level], self.scale
+
+    def adapt(self, elapsed):
+        # Returns the time to wait before the next frame: slow clients get fewer frames
+        server = self.server
+        self.write_time += (elapsed - self.write_time) * self.SMOOTHING
+        self.frames += 1
+        if self.frames >= server.ADAPT_FRAMES and self.overlay != 'camera':
+            if self.write_time > server.SLOW_WRITE and self.level < len(server.QUALITY_LEVELS) - 1:
+                self.level += 1
+                self.frames = 0
+                metrics.count('stream_quality_changes_total', direction='down')
+            elif self.write_time < server.FAST_WRITE and self.level > self.requested:
+                self.level -= 1
+                self.frames = 0
+                metrics.count('stream_quality_changes_total', direction='up')
+        return max(self.interval, server.BACKOFF * self.write_time) - elapsed
+
+
 class Server(Thread):
+    STATUS_INTERVAL = 0.05  # Min time between status pushes (seconds)
+    DIAGNOSTICS = ('jitter', 'timings', 'stages', 'frames')  # Status fields that change on every frame
+    DIAGNOSTICS_INTERVAL = 1  # Min time between pushes of these (seconds), the full set is always in /status
+    QUALITY_LEVELS = (90, 75, 60, 45, 30)  # Stream JPEG qualities (clients are snapped to these to share encodes)
+    SCALES = (1, 0.75, 0.5, 0.25)          # Stream scales (same)
+    SLOW_WRITE = 0.05       # Frame write time that lowers the client's quality (seconds, smoothed)
+    FAST_WRITE = 0.01       # Frame write time that raises it back up towards the requested one
+    ADAPT_FRAMES = 10       # Min frames between quality changes
+    BACKOFF = 2             # Min time between frames, in write times (lets the socket drain)
+    SEND_BUFFER = 65536     # Stream socket send buffer (bytes), small so backpressure shows up as write time
+    PIPELINE_FEED = (True, QUALITY_LEVELS[0], 1)  # Encoded by the pipeline encoder process (process mode only)
+    CAMERA_FEED = ('camera', QUALITY_LEVELS[0], 1)  # Color frames encoded by the camera itself (RPiStream with mjpeg at this quality only)
+
     def __init__(self, core):
         super().__init__()
         self.core = core
         self.motion = core.motion
-        self.event = self.core.subscribe()
+        self.motion.listeners.append(self.changed)
+        self.encoder = Encoder(self)
         self.stopped = False
         self.loop = None
         self.runner = None
+        self.feeds = {}         # (overlay, quality, scale) -> Feed
+        self.sockets = set()    # Connected /ws clients
+        self.last_status = {}   # Last pushed status
+        self.last_diagnostics = 0  # Last time diagnostics were pushed
+        self.push_pending = False
         self.app = web.Application()
         self.app.add_routes([
             web.get('/', self.index),
             web.post('/api', self.api),
             web.get('/stream', self.stream),
             web.get('/status', self.status),
+            web.get('/ws', self.websocket),
+            web.get('/metrics', self.metrics),
         ])
 
     async def index(self, _):
         return web.FileResponse('index.html')
 
-    async def api(self, request):
-        data = await request.json()
+    def command(self, data):
         propchain = data['target'].split('.')
         prev, last = self, self
         for i in propchain: prev, last = last, getattr(last, i)
         if data['action'] == 'set': setattr(prev, propchain[-1], data['value'])
         elif data['action'] == 'call': last(*data.get('value', []))
         self.motion.update()
+
+    async def api(self, request):
+        self.command(await request.json())
         return web.Response(text='OK')
 
-    async def status(self, _):
-        data = {
+    def state(self):
+        snapshot = self.core.snapshot
+        return {
             'onborder': self.core.motion.onborder,
             'armed': self.core.motion.armed,
             'slowmode': self.core.motion.slowmode,
             'abs_rotation': self.core.motion.abs_rotation,
             'rotation': self.core.motion.rotation,
+            'velocity': self.core.motion.velocity,
             'revolution': self.core.motion.revolution,
             'angle': self.core.motion.angle,
-            'faces': self.core.faces,
-            'markers': self.core.markers,
+            'jitter': self.core.motion.timer.status(),
+            'faces': snapshot.faces,
+            'markers': snapshot.markers.to_json(),
             'handlers': list(self.core.handlers.keys()),
             'handler': self.core.handler and self.core.handler.name,
+            'detectors': sorted(self.core.active),
+            'warmup': dict(self.core.detectors.warmup),  # Cold first run time per detector (seconds)
+            'streams': [
+                {'overlay': key[0], 'quality': key[1], 'scale': key[2], 'clients': feed.clients}
+                for key, feed in list(self.feeds.items()) if feed.clients
+            ],
+            'timings': dict(self.core.timings),  # Copy, the scheduler updates it in place
+            'stages': self.core.scheduler.status(),
+            'frames': {
+                'core': self.core.subscription.status(),
+                'encoder': self.encoder.subscription.status(),
+                'handler': self.core.handler and self.core.handler.subscription.status(),
+            },
         }
-        return web.json_response(data)
+
+    async def status(self, _):
+        return web.json_response(self.state())
+
+    async def websocket(self, request):
+        # Status is pushed on changes, api commands are accepted as messages
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_json(self.state())
+        self.last_status = {}  # Next push is a full one, so nobody misses a change
+        self.last_diagnostics = 0
+        self.sockets.add(ws)
+
+        try:
+            async for message in ws:
+                if message.type != WSMsgType.TEXT: continue
+                try: self.command(json.loads(message.data))
+                except Exception as e: await ws.send_json({'error': repr(e)})
+                self.changed()
+        finally:
+            self.sockets.discard(ws)
+
+        return ws
+
+    def changed(self):
+        # Called from any thread when core or motion state might have changed
+        if self.loop is None or not self.sockets or self.push_pending: return
+        self.push_pending = True
+        self.loop.call_soon_threadsafe(self.loop.call_later, self.STATUS_INTERVAL, self.push)
+
+    def push(self):
+        self.push_pending = False
+        state = self.state()
+        if time.time() - self.last_diagnostics < self.DIAGNOSTICS_INTERVAL:
+            for key in self.DIAGNOSTICS: state[key] = self.last_status.get(key)
+        else: self.last_diagnostics = time.time()
+        diff = {k: v for k, v in state.items() if self.last_status.get(k) != v}
+        self.last_status = state
+        if not diff: return
+        text = json.dumps(diff)
+        for ws in list(self.sockets):
+            if not ws.closed: asyncio.ensure_future(ws.send_str(text))
+
+    async def metrics(self, _):
+        return web.Response(text=metrics.render(), content_type='text/plain')
+
+    def publish(self, key, jpeg, timestamp=None):
+        # Called on the event loop by the encoder thread
+        self.feeds[key].publish(jpeg, timestamp)
+
+    def watched(self, key):
+        feed = self.feeds.get(key)
+        return feed is not None and feed.clients > 0
+
+    async def next_frame(self, feed, version):
+        # Waits for a frame newer than given version, everything in between is dropped
+        while not self.stopped and feed.version <= version:
+            await asyncio.shield(feed.waiter)
+        return feed.version, feed.jpeg, feed.timestamp
 
     async def stream(self, request):
+        # /stream?overlay=0|1|camera&quality=1..100&scale=0..1&fps=N
+        # (overlay = 0: raw single channel frames, camera: the camera's own color MJPEG, quality and scale are fixed)
+        try: client = Client(self, request.query)
+        except ValueError as e: raise web.HTTPBadRequest(text=str(e))
         response = web.StreamResponse()
         response.content_type = 'multipart/x-mixed-replace; boundary=--frame'
         response.enable_chunked_encoding()
         await response.prepare(request)
+        sock = request.transport and request.transport.get_extra_info('socket')
+        if sock is not None: sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.SEND_BUFFER)
+
+        try: await self.send_frames(client, response)
+        finally:
+            if client.feed: client.feed.clients -= 1
+        return response
 
+    async def send_frames(self, client, response):
+        version = 0
         while not self.stopped:
-            self.event.wait()
-            if self.stopped: break
-            self.event.clear()
+            if client.feed is None or client.feed is not self.feeds.get(client.key):
+                # New client or quality change: move over to the matching feed
+                if client.feed: client.feed.clients -= 1
+                feed = client.feed = self.feeds.get(client.key) or self.feeds.setdefault(client.key, Feed(self.loop))
+                version = feed.version - 1 if feed.clients else feed.version  # Idle feeds have stale frames
+                feed.clients += 1
 
-            _, jpeg = cv2.imencode('.jpg', self.core.frame)
-            jpeg = jpeg.tobytes()
+            version, jpeg, timestamp = await self.next_frame(client.feed, version)
+            if self.stopped: break
 
             data = '\r\n'.join((
                 '--frame',
@@ -71,10 +328,14 @@ class Server(Thread):
                 '', ''  # It just works!
             )).encode() + jpeg
 
-            # Let asyncio handle other requests
-            await asyncio.sleep(0)
+            start = time.time()
             try: await response.write(data)
             except: break
+            elapsed = time.time() - start
+            metrics.observe('stage_seconds', elapsed, stage='stream')
+            if timestamp: metrics.observe('glass_to_stream_seconds', time.time() - timestamp)
+            delay = client.adapt(elapsed)
+            if delay > 0: await asyncio.sleep(delay)
 
     def run(self):
         self.loop = asyncio.new_event_loop()
@@ -86,13 +347,16 @@ class Server(Thread):
         await self.runner.setup()
         site = web.TCPSite(self.runner, '0.0.0.0', 80)
         await site.start()
+        self.encoder.start()
 
     def stop(self):
         self.stopped = True
-        if not self.event.is_set(): self.event.set()
+        if self.encoder.is_alive(): self.encoder.stop()  # Never started if the server failed to start
         asyncio.run_coroutine_threadsafe(self.stop_async(), self.loop)
         self.join()
 
     async def stop_async(self):
+        for feed in list(self.feeds.values()): feed.close()
+        for ws in list(self.sockets): await ws.close()
         await self.runner.cleanup()
         self.loop.stop()
@@ -0,0 +1,23 @@
+from collections import namedtuple
+from stream import BufferPool
+from markers import Markers
+from overlay import Overlay
+
+__all__ = [
+    'Snapshot',
+]
+
+
+class Snapshot(namedtuple('Snapshot', 'seq timestamp image gray markers faces overlay')):
+    # Everything consumers get from one processed frame, published as a whole and never modified.
+    # Images are read-only views of ring buffers held through BufferPool.hold, a slot isn't reused while they're alive
+    __slots__ = ()
+
+    @classmethod
+    def create(cls, seq, timestamp, image, gray, markers, faces, overlay):
+        faces = tuple(tuple(int(i) for i in face) for face in faces)
+        return cls(seq, timestamp, BufferPool.hold(image), BufferPool.hold(gray), markers, faces, overlay)
+
+    @classmethod
+    def empty(cls):
+        return cls(0, None, None, None, Markers(), (), Overlay())
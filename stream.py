@@ -1,66 +1,276 @@
 # Raspberry Pi | PyPI: picamera
-try:
-    from picamera.array import PiRGBArray
-    from picamera import PiCamera
+try: from picamera import PiCamera
 except ImportError: pass
 
-from threading import Thread, Event
+from threading import Thread, Lock
+from metrics import metrics
+from bus import FrameBus
 from time import sleep
+import numpy as np
+import json
+import time
+import weakref
 import cv2
+import os
 
 __all__ = [
+    'BufferPool',
+    'FrameLog',
     'BaseStream',
     'RPiStream',
+    'SimPiCamera',
     'CVStream',
-    'FakeStream'
+    'FakeStream',
+    'RecordStream',
+    'ReplayStream',
 ]
 
 
+class BufferPool:
+    # A slot is only reused when no reader holds it: readers get frames as views from hold(), while one
+    # of them is alive the slot gets a new buffer instead and the reader keeps its frame
+    holds = {}     # id(buffer) -> held views (all pools, the views keep the buffer alive so ids aren't reused)
+    lock = Lock()  # Views are released from whichever thread drops them
+
+    def __init__(self, size=0):
+        self.buffers = [None] * size  # Ring of reusable frame buffers (size 0 = allocate every time)
+        self.index = -1
+
+    def next(self, shape=None, dtype=np.uint8):
+        # Next buffer of the ring, (re)allocated if shape doesn't match or it is held elsewhere
+        # (None if a new buffer is needed but shape is not known yet)
+        if not self.buffers: return None if shape is None else np.empty(shape, dtype)
+        self.index = (self.index + 1) % len(self.buffers)
+        buffer = self.buffers[self.index]
+        if buffer is not None and self.held(buffer): buffer = self.buffers[self.index] = None
+        if shape is not None and (buffer is None or buffer.shape != tuple(shape) or buffer.dtype != dtype):
+            buffer = self.buffers[self.index] = np.empty(shape, dtype)
+        return buffer
+
+    @classmethod
+    def hold(cls, array):
+        # Read-only view of the array, its buffer isn't reused by any pool as long as the view is alive
+        if array is None: return None
+        buffer = array
+        while isinstance(buffer.base, np.ndarray): buffer = buffer.base
+        view = array.view()
+        view.flags.writeable = False
+        with cls.lock: cls.holds[id(buffer)] = cls.holds.get(id(buffer), 0) + 1
+        weakref.finalize(view, cls.release, id(buffer))
+        return view
+
+    @classmethod
+    def release(cls, key):
+        with cls.lock:
+            cls.holds[key] -= 1
+            if not cls.holds[key]: del cls.holds[key]
+
+    @classmethod
+    def held(cls, buffer):
+        with cls.lock: return id(buffer) in cls.holds
+
+    def keep(self, buffer):
+        # Puts the buffer allocated by somebody else (e.g. OpenCV) into the current slot
+        if self.buffers: self.buffers[self.index] = buffer
+        return buffer
+
+
+class FrameLog:
+    # Folder with raw frames (frames.bin), their timestamps (timestamps.bin) and frame format (meta.json)
+    def __init__(self, path):
+        self.path = path
+        self.shape = None
+        self.dtype = None
+        self.files = None
+        meta = os.path.join(path, 'meta.json')
+        if os.path.isfile(meta):
+            with open(meta) as file: meta = json.load(file)
+            self.shape, self.dtype = tuple(meta['shape']), np.dtype(meta['dtype'])
+
+    @staticmethod
+    def exists(path):
+        return os.path.isfile(os.path.join(path, 'meta.json'))
+
+    def write(self, frame, timestamp):
+        if self.files is None:
+            os.makedirs(self.path, exist_ok=True)
+            if self.shape is None:
+                self.shape, self.dtype = frame.shape, frame.dtype
+                with open(os.path.join(self.path, 'meta.json'), 'w') as file:
+                    json.dump({'shape': list(self.shape), 'dtype': self.dtype.str}, file)
+            self.files = [open(os.path.join(self.path, i), 'ab') for i in ('frames.bin', 'timestamps.bin')]
+        if frame.shape != self.shape or frame.dtype != self.dtype: return False
+        np.ascontiguousarray(frame).tofile(self.files[0])
+        np.float64(timestamp).tofile(self.files[1])
+        return True
+
+    def close(self):
+        if self.files is None: return
+        for file in self.files: file.close()
+        self.files = None
+
+    def read(self):
+        # Frames are memory mapped, nothing is loaded until it's used
+        timestamps = np.fromfile(os.path.join(self.path, 'timestamps.bin'), np.float64)
+        size = int(np.prod(self.shape)) * self.dtype.itemsize
+        count = min(len(timestamps), os.path.getsize(os.path.join(self.path, 'frames.bin')) // size)
+        if not count: return np.empty((0,) + self.shape, self.dtype), timestamps[:0]
+        frames = np.memmap(os.path.join(self.path, 'frames.bin'), self.dtype, 'r', shape=(count,) + self.shape)
+        return frames, timestamps[:count]
+
+
 class BaseStream(Thread):
-    def __init__(self):
+    def __init__(self, buffers=0):
         super().__init__()
         self.frame = None
         self.stopped = False
-        self.events = []
+        self.bus = FrameBus()
+        self.pool = BufferPool(buffers)
 
     def subscribe(self):
-        event = Event()
-        self.events.append(event)
-        return event
+        return self.bus.subscribe()
 
-    def notify(self):
-        for event in self.events:
-            event.set()
+    def notify(self, timestamp=None):
+        self.bus.publish(self.frame, timestamp)
 
     def stop(self):
         self.stopped = True
         self.join()
 
 
+class FrameOutput:
+    # picamera output for unencoded video port frames: every write() is one frame, rows padded to 32 px
+    # and height to 16 px. The frame is copied out, the camera reuses its buffer
+    def __init__(self, stream, resolution, format):
+        self.stream = stream
+        self.width, self.height = resolution
+        self.padded = ((self.width + 31) // 32 * 32, (self.height + 15) // 16 * 16)
+        self.format = format
+
+    def write(self, buf):
+        width, height = self.padded
+        if self.format == 'yuv':
+            # I420: the Y plane comes first, it is the gray frame as is
+            plane = np.frombuffer(buf, np.uint8, width * height).reshape(height, width)
+        else: plane = np.frombuffer(buf, np.uint8, width * height * 3).reshape(height, width, 3)
+        plane = plane[:self.height, :self.width]
+        self.stream.frame = frame = self.stream.pool.next(plane.shape)
+        np.copyto(frame, plane)
+        self.stream.notify()
+        return len(buf)
+
+    def flush(self): pass
+
+
+class JpegOutput:
+    # picamera output for the MJPEG encoder, a frame may come in several writes
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = bytearray()
+        self.seq = 0
+
+    def write(self, buf):
+        self.buffer.extend(buf)
+        if self.buffer.endswith(b'\xff\xd9'):
+            self.seq += 1
+            self.stream.jpeg = (self.seq, bytes(self.buffer), time.time())
+            self.buffer.clear()
+        return len(buf)
+
+    def flush(self): pass
+
+
+class SimPiCamera(Thread):
+    # The part of PiCamera RPiStream uses, for testing off-device: FakeStream frames delivered
+    # like the firmware does (padded BGR / I420 buffers on the video port, MJPEG chunks on the splitter port)
+    MAX_RESOLUTION = (640, 480)
+    MAX_FRAMERATE = 30
+
+    def __init__(self, resolution=None, framerate=None, image='data/dog.jpg'):
+        super().__init__(daemon=True)
+        self.resolution = resolution or self.MAX_RESOLUTION
+        self.framerate = framerate or self.MAX_FRAMERATE
+        self.image = cv2.resize(cv2.imread(image), self.resolution)
+        self.outputs = {}  # Splitter port -> (output, format, quality)
+        self.hflip = False
+        self.vflip = False
+        self.closed = False
+
+    def start_recording(self, output, format, splitter_port=1, quality=85, **_):
+        self.outputs[splitter_port] = (output, format, quality)
+        if not self.is_alive(): self.start()
+
+    def wait_recording(self, timeout=0, splitter_port=1):
+        sleep(timeout)
+
+    def stop_recording(self, splitter_port=1):
+        self.outputs.pop(splitter_port, None)
+
+    def close(self):
+        self.closed = True
+        if self.is_alive(): self.join()
+
+    def buffer(self, image, format, quality):
+        if format == 'mjpeg': return cv2.imencode('.jpg', image, (cv2.IMWRITE_JPEG_QUALITY, quality))[1].tobytes()
+        width, height = self.resolution
+        padded = cv2.copyMakeBorder(image, 0, (-height) % 16, 0, (-width) % 32, cv2.BORDER_CONSTANT)
+        if format == 'yuv': padded = cv2.cvtColor(padded, cv2.COLOR_BGR2YUV_I420)
+        return padded.tobytes()
+
+    def run(self):
+        start, count = time.time(), 0
+        while not self.closed:
+            self.image = cv2.rotate(self.image, cv2.ROTATE_180)
+            image = self.image
+            if self.hflip: image = cv2.flip(image, 1)
+            if self.vflip: image = cv2.flip(image, 0)
+            for output, format, quality in list(self.outputs.values()):
+                data = self.buffer(image, format, quality)
+                if format == 'mjpeg':
+                    half = len(data) // 2
+                    output.write(data[:half])
+                    output.write(data[half:])
+                else: output.write(data)
+            count += 1
+            delay = start + count / self.framerate - time.time()
+            if delay > 0: sleep(delay)
+
+
 class RPiStream(BaseStream):
-    def __init__(self, width=None, height=None, fps=None):
-        super().__init__()
-        resolution = (width, height) if width and height else PiCamera.MAX_RESOLUTION
-        framerate = fps or PiCamera.MAX_FRAMERATE
-        self.camera = PiCamera(resolution=resolution, framerate=framerate)
-        self.capture = PiRGBArray(self.camera, size=resolution)
-        self.stream = self.camera.capture_continuous(self.capture, format='bgr', use_video_port=True)
+    # format: 'bgr' = color frames | 'yuv' = the Y plane is the frame (gray, Core skips cvtColor)
+    # mjpeg: the camera encodes the raw stream itself (splitter port 2), so the CPU doesn't have to
+    # backend: 'picamera' = the real camera | 'sim' = SimPiCamera (off-device testing)
+    # flip: cv2.flip code applied by the camera itself (all ports, the MJPEG stream too)
+    def __init__(self, width=None, height=None, fps=None, buffers=0, format='bgr', mjpeg=False, quality=90,
+                 backend='picamera', flip=None):
+        super().__init__(buffers)
+        camera = SimPiCamera if backend == 'sim' else PiCamera
+        resolution = (width, height) if width and height else camera.MAX_RESOLUTION
+        framerate = fps or camera.MAX_FRAMERATE
+        self.camera = camera(resolution=resolution, framerate=framerate)
+        self.camera.hflip = flip in (1, -1)
+        self.camera.vflip = flip in (0, -1)
+        self.output = FrameOutput(self, resolution, format)
+        self.format = format
+        self.mjpeg = mjpeg
+        self.quality = quality
+        self.flip = flip
+        self.jpeg = None  # (seq, bytes, timestamp) from the camera MJPEG encoder (mjpeg only)
 
     def run(self):
+        self.camera.start_recording(self.output, format=self.format, splitter_port=1)
+        if self.mjpeg: self.camera.start_recording(JpegOutput(self), format='mjpeg', splitter_port=2, quality=self.quality)
         while not self.stopped:
-            framedata = next(self.stream)
-            self.frame = framedata.array
-            self.capture.truncate(0)
-            self.notify()
+            self.camera.wait_recording(0.5)
 
-        self.stream.close()
-        self.capture.close()
+        if self.mjpeg: self.camera.stop_recording(splitter_port=2)
+        self.camera.stop_recording(splitter_port=1)
         self.camera.close()
 
 
 class CVStream(BaseStream):
-    def __init__(self, width=None, height=None, fps=None):
-        super().__init__()
+    def __init__(self, width=None, height=None, fps=None, buffers=0):
+        super().__init__(buffers)
         self.capture = cv2.VideoCapture(0)
         if width: self.capture.set(cv2.CAP_PROP_FRAME_WIDTH, width)
         if height: self.capture.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
@@ -68,15 +278,15 @@ class CVStream(BaseStream):
 
     def run(self):
         while not self.stopped:
-            ok, frame = self.capture.read()
+            ok, frame = self.capture.read(self.pool.next())
             if not ok: continue
-            self.frame = frame
+            self.frame = self.pool.keep(frame)
             self.notify()
 
 
 class FakeStream(BaseStream):
-    def __init__(self, width=None, height=None, fps=None):
-        super().__init__()
+    def __init__(self, width=None, height=None, fps=None, buffers=0):
+        super().__init__(buffers)
         self.fps = fps or 10
         self.image = cv2.imread('data/dog.jpg')
         self.size = (width, height) if width and height else None
@@ -89,3 +299,63 @@ class FakeStream(BaseStream):
             self.frame = self.image
             self.notify()
             sleep(1 / self.fps)
+
+
+class RecordStream(BaseStream):
+    def __init__(self, source, path):
+        super().__init__()
+        self.source = source
+        self.subscription = source.subscribe()
+        self.log = FrameLog(path)
+        self.rejected = 0  # Frames not recorded, their format differs from the log's
+
+    def stop(self):
+        self.stopped = True
+        self.subscription.close()
+        self.join()
+
+    def run(self):
+        # Passes source frames through, writing them to the frame log on the way
+        self.source.start()
+        while not self.stopped:
+            item = self.subscription.next()
+            if item is None: break
+            _, timestamp, frame = item
+            if frame is None: continue
+            if not self.log.write(frame, timestamp):
+                if not self.rejected: print('[RECORD] FRAMES NOT MATCHING THE LOG FORMAT ARE SKIPPED:', frame.shape, frame.dtype)
+                self.rejected += 1
+                metrics.count('recorded_frames_rejected_total')
+            self.frame = frame
+            self.notify(timestamp)
+
+        self.source.stop()
+        self.log.close()
+
+
+class ReplayStream(BaseStream):
+    def __init__(self, width=None, height=None, fps=None, buffers=0, path='recording', speed=1, loop=True):
+        super().__init__(buffers)
+        if not FrameLog.exists(path): raise FileNotFoundError('no frame log (meta.json) in %s' % path)
+        self.log = FrameLog(path)
+        self.size = (width, height) if width and height else None
+        self.speed = speed  # Replay speed (1 = original, 2 = twice as fast, 0 = lockstep: every frame as soon as consumed)
+        self.loop = loop
+
+    def run(self):
+        frames, timestamps = self.log.read()
+        while not self.stopped and len(frames):
+            # Deadlines are absolute (relative to replay start), so sleep errors don't add up
+            start = time.time()
+            for frame, timestamp in zip(frames, timestamps):
+                if self.stopped: break
+                if self.speed:
+                    delay = start + (timestamp - timestamps[0]) / self.speed - time.time()
+                    if delay > 0: sleep(delay)
+                if self.size and frame.shape[1::-1] != self.size:
+                    frame = cv2.resize(frame, self.size, dst=self.pool.next(self.size[::-1] + frame.shape[2:]))
+                self.frame = frame
+                self.notify()
+                # Deterministic replay: the next frame only goes out once every subscriber took this one
+                while not self.speed and not self.stopped and not self.bus.wait_consumed(timeout=0.5): pass
+            if not self.loop: break
@@ -0,0 +1,109 @@
+from math import atan, pi
+import numpy as np
+import time
+
+__all__ = [
+    'FaceTracker',
+    'KalmanFilter',
+    'TargetTracker',
+]
+
+
+class FaceTracker:
+    # Full frame haar scan every N frames, in between only the area around known faces is searched.
+    # Faces are scanned for in the full frame on every frame while nothing is tracked,
+    # so "no faces" (which arms the turret) is always the result of a full scan.
+    def __init__(self, cascade, interval=10, margin=0.5, **params):
+        self.cascade = cascade
+        self.interval = interval  # Full scan interval (frames)
+        self.margin = margin      # ROI expansion (fraction of face size)
+        self.params = params      # detectMultiScale params
+        self.faces = np.empty((0, 4), int)
+        self.countdown = 0
+
+    def scan(self, gray, offset=(0, 0)):
+        faces = self.cascade.detectMultiScale(gray, **self.params)
+        if not len(faces): return np.empty((0, 4), int)
+        return faces + (offset[0], offset[1], 0, 0)
+
+    def roi(self, shape):
+        x0, y0 = np.min(self.faces[:, :2], axis=0)
+        x1, y1 = np.max(self.faces[:, :2] + self.faces[:, 2:], axis=0)
+        pad = int(np.max(self.faces[:, 2:]) * self.margin)
+        return max(x0 - pad, 0), max(y0 - pad, 0), min(x1 + pad, shape[1]), min(y1 + pad, shape[0])
+
+    def __call__(self, gray):
+        faces = None
+        if len(self.faces) and self.countdown > 0:
+            self.countdown -= 1
+            x0, y0, x1, y1 = self.roi(gray.shape)
+            faces = self.scan(gray[y0:y1, x0:x1], (x0, y0))
+            if len(faces) < len(self.faces): faces = None  # Lost someone, rescan everything
+
+        if faces is None:
+            faces = self.scan(gray)
+            self.countdown = self.interval - 1
+
+        self.faces = faces
+        return faces
+
+
+class KalmanFilter:
+    # Constant velocity model for one coordinate: state is (position, velocity)
+    def __init__(self, position, timestamp, process=20, measurement=0.5, velocity=20):
+        self.q = process ** 2      # Target acceleration variance
+        self.r = measurement ** 2  # Measurement variance
+        self.x = np.array([position, 0.0])
+        self.P = np.diag([self.r, velocity ** 2])
+        self.timestamp = timestamp
+
+    def predict(self, timestamp):
+        dt = max(timestamp - self.timestamp, 0)
+        F = np.array([[1, dt], [0, 1]])
+        Q = self.q * np.array([[dt ** 4 / 4, dt ** 3 / 2], [dt ** 3 / 2, dt ** 2]])
+        return F @ self.x, F @ self.P @ F.T + Q
+
+    def update(self, position, timestamp):
+        if timestamp < self.timestamp: return  # Out of order measurement
+        x, P = self.predict(timestamp)
+        gain = P[:, 0] / (P[0, 0] + self.r)
+        self.x = x + gain * (position - x[0])
+        self.P = P - np.outer(gain, P[0, :])
+        self.timestamp = timestamp
+
+    def position(self, timestamp):
+        return self.predict(timestamp)[0][0]
+
+
+class TargetTracker:
+    # Tracks targets in turret coordinates (steps, same direction as motion.abs_rotation),
+    # so the turret's own motion doesn't look like target motion
+    TIMEOUT = 1              # Forget targets not seen for this long (seconds)
+    PROCESS_NOISE = 20       # Target acceleration std (steps / s^2)
+    MEASUREMENT_NOISE = 0.5  # Detection std (steps)
+
+    def __init__(self, motion, matrix, lead=0.1):
+        self.fx = matrix[0][0]           # Focal length (px), matrix is at the working resolution
+        self.cx = matrix[0][2]           # Optical center (px)
+        self.motion = motion
+        self.lead = lead                 # Extra prediction time for motor response (seconds)
+        self.filters = {}                # Target key -> KalmanFilter
+
+    def bearing(self, x):
+        # Pixel column -> angle from the optical axis (steps, positive = right)
+        return atan((x - self.cx) / self.fx) / (2 * pi) * self.motion.revolution
+
+    def update(self, key, x, timestamp):
+        # Turret position at capture time compensates pipeline latency
+        position = self.motion.position_at(timestamp) * self.motion.revolution - self.bearing(x)
+        for k in [k for k, f in self.filters.items() if timestamp - f.timestamp > self.TIMEOUT]: del self.filters[k]
+        if key in self.filters: self.filters[key].update(position, timestamp)
+        else: self.filters[key] = KalmanFilter(position, timestamp, self.PROCESS_NOISE, self.MEASUREMENT_NOISE)
+
+    def aim(self, key):
+        # Predicted target position (motion.abs_rotation units) by the time the motor gets there
+        return self.filters[key].position(time.time() + self.lead) / self.motion.revolution
+
+    def error(self, key):
+        # Steps between where the turret is and where the target will be
+        return (self.motion.abs_rotation - self.aim(key)) * self.motion.revolution
@@ -0,0 +1,72 @@
+import numpy as np
+import hashlib
+import cv2
+import json
+import os
+
+__all__ = [
+    'Undistorter',
+    'load_calibration',
+]
+
+
+def load_calibration(path, matrix, distortion, calibration_size):
+    # Calibration file written by calib/calibrate.py, falls back to the given values if there's none
+    if not path or not os.path.isfile(path): return matrix, distortion, calibration_size
+    with open(path) as file: data = json.load(file)
+    print('LOADED CAMERA CALIBRATION:', path, '(RMS %.3f)' % data.get('rms', 0))
+    return np.array(data['matrix']), np.array(data['distortion']), tuple(data['size'])
+
+
+class Undistorter:
+    def __init__(self, matrix, distortion, calibration_size, cache=None):
+        self.matrix = np.asarray(matrix, np.float64)
+        self.distortion = np.asarray(distortion, np.float64)
+        self.calibration_size = tuple(calibration_size)
+        self.cache = cache  # Remap tables folder (None = memory only)
+        self.maps = {}      # (width, height) -> (map1, map2)
+
+    def scaled(self, size):
+        # Camera matrix for another resolution
+        matrix = self.matrix.copy()
+        matrix[0] *= size[0] / self.calibration_size[0]
+        matrix[1] *= size[1] / self.calibration_size[1]
+        return matrix
+
+    def key(self, size):
+        data = self.matrix.tobytes() + self.distortion.tobytes() + np.array(self.calibration_size + size).tobytes()
+        return hashlib.sha1(data).hexdigest()[:16]
+
+    def remap_tables(self, size):
+        # Built once per resolution, cached on disk keyed by calibration and resolution
+        if size in self.maps: return self.maps[size]
+        path = self.cache and os.path.join(self.cache, 'undistort_%s_%dx%d.npz' % ((self.key(size),) + size))
+        if path and os.path.isfile(path):
+            with np.load(path) as data: maps = data['map1'], data['map2']
+        else:
+            matrix = self.scaled(size)
+            maps = cv2.initUndistortRectifyMap(matrix, self.distortion, None, matrix, size, cv2.CV_16SC2)
+            if path:
+                os.makedirs(self.cache, exist_ok=True)
+                np.savez(path, map1=maps[0], map2=maps[1])
+        self.maps[size] = maps
+        return maps
+
+    def frame(self, image, dst=None):
+        map1, map2 = self.remap_tables((image.shape[1], image.shape[0]))
+        return cv2.remap(image, map1, map2, cv2.INTER_LINEAR, dst=dst)
+
+    def points(self, points, size):
+        # (N, 2) distorted pixel coordinates -> undistorted ones (same camera matrix)
+        if not len(points): return points
+        matrix = self.scaled(size)
+        points = np.asarray(points, np.float32).reshape(-1, 1, 2)
+        return cv2.undistortPoints(points, matrix, self.distortion, P=matrix).reshape(-1, 2)
+
+    def rects(self, rects, size):
+        # Moves (x, y, w, h) rects so that their centers are undistorted
+        if not len(rects): return rects
+        rects = np.asarray(rects)
+        centers = rects[:, :2] + rects[:, 2:] / 2
+        shift = self.points(centers, size) - centers
+        return np.hstack([rects[:, :2] + np.round(shift).astype(rects.dtype), rects[:, 2:]])